@@ -69,10 +69,23 @@ def main():
     # These imports happen here rather than at the top level because if gst
     # gets imported before the above KCmdLineArgs.init() call, it steals our
     # --help option
-    from minirok import engine, main_window as mw, scrobble
+    from minirok import (
+        engine,
+        main_window as mw,
+        preferences,
+        scrobble,
+        tag_reader,
+    )
 
     minirok.Globals.engine = engine.Engine()
     application = kdeui.KApplication()
+
+    # Tag reader processes have to be forked before any thread is started.
+    minirok.Globals.preferences = preferences.Preferences()
+    if minirok.Globals.preferences.tag_reader_processes:
+        tag_reader.start_process_pool(
+            minirok.Globals.preferences.tag_reader_threads)
+
     main_window = mw.MainWindow()
     scrobbler = scrobble.Scrobbler()
     scrobbler.start()
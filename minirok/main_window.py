@@ -31,7 +31,6 @@ class MainWindow(kdeui.KXmlGuiWindow):
         util.CallbackRegistry.register_save_config(self.save_config)
 
         minirok.Globals.action_collection = self.actionCollection()
-        minirok.Globals.preferences = preferences.Preferences()
 
         self.main_view = QtGui.QSplitter(self)
         self.left_side = left_side.LeftSide(self.main_view)
@@ -6,6 +6,7 @@
 
 import minirok
 
+import cPickle
 import errno
 import os
 import re
@@ -35,6 +36,11 @@ class Playlist(QtCore.QAbstractTableModel):
     RoleQueryIsPlaying   = Qt.UserRole + 3
     RoleQueryIsStopAfter = Qt.UserRole + 4
 
+    # Edits to remember before recomputing all positions, see position_of().
+    POSITION_EDITS_MAX = 64
+
+    SAVED_PLAYLIST_VERSION = 1
+
     def __init__(self, parent=None):
         QtCore.QAbstractTableModel.__init__(self, parent)
         util.CallbackRegistry.register_save_config(self.save_config)
@@ -43,16 +49,40 @@ class Playlist(QtCore.QAbstractTableModel):
         # Core model stuff
         self._itemlist = []
         self._row_count = 0
+
+        # Display text of each column, and lengths in seconds, kept in lists
+        # parallel to _itemlist so that data() does not have to ask items.
+        self._columns = [[] for tag in PlaylistItem.ALLOWED_TAGS]
+        self._lengths = []
+
+        # Positions of items are updated lazily, see position_of().
+        self._generation = 0
+        self._edits = []  # (threshold, delta) since the last renumbering
+
         self._empty_model_index = QtCore.QModelIndex()
         self._column_count = len(PlaylistItem.ALLOWED_TAGS)
 
         self.queue = []
         self.visualizer_rect = None
         self.stop_mode = StopMode.NONE
-        self.tag_reader = tag_reader.TagReader()
-        self.random_queue = util.RandomOrderedList()
+        self.tag_reader = tag_reader.TagReader(
+            minirok.Globals.preferences.tag_reader_threads,
+            minirok.Globals.preferences.tag_reader_processes,
+            minirok.Globals.preferences.tag_reader_disk_order)
+        self.random_queue = util.RandomQueue()
+
+        # Items for add_files() are created in this thread, and inserted in
+        # chunks as they become ready.
+        self.item_creator = util.ThreadedWorker(
+            lambda chunk: map(self.create_item, chunk.paths))
+        self._add_operations = []
+        self._legacy_load = None  # See load_legacy_saved_playlist().
+
+        # Used by add_files_untrusted() to check files and read directories.
+        self.path_walker = util.PlayableFilesWalker(self)
 
         self.tag_reader.start()
+        self.item_creator.start()
 
         # these have a property() below
         self._stop_after = None
@@ -69,6 +99,10 @@ class Playlist(QtCore.QAbstractTableModel):
                      QtCore.SIGNAL('items_ready'),
                      self.slot_update_tags)
 
+        self.connect(self.item_creator,
+                     QtCore.SIGNAL('items_ready'),
+                     self.slot_insert_created_items)
+
         self.connect(minirok.Globals.engine,
                      QtCore.SIGNAL('status_changed'),
                      self.slot_engine_status_changed)
@@ -116,7 +150,7 @@ class Playlist(QtCore.QAbstractTableModel):
             ret = None
 
         elif role == Qt.DisplayRole:
-            ret = QtCore.QString(self._itemlist[row].tag_by_index(column) or '')
+            ret = QtCore.QString(self._columns[column][row])
 
         elif role == Qt.TextAlignmentRole:
             c = PlaylistItem.ALLOWED_TAGS[column]
@@ -189,14 +223,15 @@ class Playlist(QtCore.QAbstractTableModel):
             files = map(util.kurl_to_path,
                         kdecore.KUrl.List.fromMimeData(mimedata))
 
-            if not mimedata.hasFormat(drag.FileListDrag.MIME_TYPE):
-                # Drop does not come from ourselves, so:
-                files = util.playable_from_untrusted(files, warn=False)
-
             if (QtGui.QApplication.keyboardModifiers() & Qt.ControlModifier):
                 row = -1
 
-            self.add_files(files, position=row)
+            if mimedata.hasFormat(drag.FileListDrag.MIME_TYPE):
+                self.add_files(files, position=row)
+            else:
+                # Drop does not come from ourselves, so:
+                self.add_files_untrusted(files, position=row, warn=False)
+
             return True
 
         elif mimedata.hasFormat(self.PLAYLIST_DND_MIME_TYPE):
@@ -254,10 +289,7 @@ class Playlist(QtCore.QAbstractTableModel):
 
         try:
             nitems = len(items)
-            for item in self._itemlist[position:]:
-                item.position += nitems
-            for i, item in enumerate(items):
-                item.position = position + i
+            for item in items:
                 if (playing_path is not None
                     and playing_path == item.path):
                     current_item = item
@@ -266,6 +298,15 @@ class Playlist(QtCore.QAbstractTableModel):
                                  position, position + nitems - 1)
             self._itemlist[position:0] = items
             self._row_count += nitems
+            self._log_position_edit(position, nitems)
+            for i, item in enumerate(items):
+                item._position = position + i
+                item._generation = self._generation
+            for column, texts in enumerate(self._columns):
+                texts[position:position] = [
+                    x.tag_by_index(column) or u'' for x in items]
+            self._lengths[position:position] = [
+                x.tag('Length') for x in items]
         finally:
             self.endInsertRows()
 
@@ -284,23 +325,21 @@ class Playlist(QtCore.QAbstractTableModel):
             if item.needs_tag_reader:
                 self.tag_reader.dequeue(item)
             if not item.already_played:
-                try:
-                    self.random_queue.remove(item)
-                except ValueError:
-                    pass
+                self.random_queue.discard(item)
             if item is self.current_item:
                 self.current_item = self.FIRST_ITEM
 
-            item.position = None
-
-        for item in self._itemlist[position+amount:]:
-            item.position -= amount
+            item._position = None
 
         try:
             self.beginRemoveRows(QtCore.QModelIndex(),
                                  position, position + amount - 1)
             self._itemlist[position:position+amount] = []
             self._row_count -= amount
+            self._log_position_edit(position + amount, -amount)
+            for texts in self._columns:
+                del texts[position:position+amount]
+            del self._lengths[position:position+amount]
         finally:
             self.endRemoveRows()
 
@@ -309,17 +348,92 @@ class Playlist(QtCore.QAbstractTableModel):
 
     def clear_itemlist(self):
         self.current_item = None
-        self.random_queue[:] = []
+        self.random_queue.clear()
         self.tag_reader.clear_queue()
 
         items = self._itemlist[:]
         self._row_count = 0
         self._itemlist[:] = []
+        self._edits[:] = []
+
+        for item in items:
+            item._position = None
+        for texts in self._columns:
+            texts[:] = []
+        self._lengths[:] = []
         self.reset()
 
         self.emit(QtCore.SIGNAL('list_changed'))
         return items
 
+    def position_of(self, item):
+        """Return the row of an item, or None if it's not in the playlist.
+
+        Rows are not updated for every item after an insertion or removal.
+        Instead, each item records its row as of a certain generation, and
+        the edits done since then are replayed here to bring it up to date.
+        After POSITION_EDITS_MAX edits, all rows are recomputed at once.
+        """
+        position = item._position
+
+        if position is not None and item._generation != self._generation:
+            start = len(self._edits) - (self._generation - item._generation)
+            for threshold, delta in self._edits[start:]:
+                if position >= threshold:
+                    position += delta
+            item._position = position
+            item._generation = self._generation
+
+        return position
+
+    def _log_position_edit(self, threshold, delta):
+        """Record that rows from threshold on have moved by delta.
+
+        Must be called after _itemlist has been modified.
+        """
+        self._generation += 1
+
+        if len(self._edits) < self.POSITION_EDITS_MAX:
+            self._edits.append((threshold, delta))
+        else:
+            for i, item in enumerate(self._itemlist):
+                item._position = i
+                item._generation = self._generation
+            self._edits[:] = []
+
+    def update_item_tags(self, item, tags):
+        """Update the tags of an item, returning the columns that changed.
+
+        This must be used instead of item.update_tags() for items in the
+        playlist, so that the display text of the columns is kept in sync.
+        """
+        columns = item.update_tags(tags)
+        row = self.position_of(item)
+
+        if columns and row is not None:
+            for column in columns:
+                self._columns[column][row] = item.tag_by_index(column) or u''
+            self._lengths[row] = item.tag('Length')
+
+        return columns
+
+    ##
+
+    """Aggregates."""
+
+    def total_length(self):
+        """Return the sum of the lengths of all items, in seconds."""
+        return sum(x for x in self._lengths if x is not None)
+
+    def tag_counts(self, tag):
+        """Return a dict with the number of items for each value of a tag."""
+        counts = {}
+
+        for value in self._columns[PlaylistItem.TAG_INDEX[tag]]:
+            counts[value] = counts.get(value, 0) + 1
+
+        return counts
+
     ##
 
     """Initialization."""
@@ -432,10 +546,7 @@ class Playlist(QtCore.QAbstractTableModel):
     def _set_current_item(self, value):
         if not (value is self.FIRST_ITEM and self._row_count == 0):
             self._current_item = value
-            try:
-                self.random_queue.remove(value)
-            except ValueError:
-                pass
+            self.random_queue.discard(value)
         else:
             self._current_item = None
 
@@ -444,7 +555,7 @@ class Playlist(QtCore.QAbstractTableModel):
 
         if self.current_item not in (self.FIRST_ITEM, None):
             self.emit(QtCore.SIGNAL('scroll_needed'),
-                      self.index(self.current_item.position, 0))
+                      self.index(self.position_of(self.current_item), 0))
 
     current_item = property(lambda self: self._current_item, _set_current_item)
 
@@ -471,7 +582,7 @@ class Playlist(QtCore.QAbstractTableModel):
             if self.current_item is self.FIRST_ITEM:
                 current = 0
             else:
-                current = self.current_item.position
+                current = self.position_of(self.current_item)
             self.action_clear.setEnabled(True)
             self.action_previous.setEnabled(current > 0)
             self.action_next.setEnabled(
@@ -508,7 +619,12 @@ class Playlist(QtCore.QAbstractTableModel):
     """Other slots."""
 
     def slot_clear(self):
+        # Files still being added would end up in the cleared playlist.
+        for operation in self._add_operations:
+            operation.cancelled = True
+
         ClearItemlistCmd(self)
+        self.emit_add_progress()
 
     def slot_activate_index(self, index):  # Proxy reimplements this too.
         self.maybe_populate_random_queue()
@@ -522,15 +638,23 @@ class Playlist(QtCore.QAbstractTableModel):
             self.toggle_stop_after_item(current)
 
     def slot_update_tags(self):
-        rows = []
+        changed = {}  # row -> list of columns that changed
 
         for item, tags in self.tag_reader.pop_done():
-            item.update_tags(tags)
+            columns = self.update_item_tags(item, tags)
             item.needs_tag_reader = False
-            rows.append(item.position)
-
-        if rows:
-            self.my_emit_dataChanged(min(rows), max(rows))
+            row = self.position_of(item)
+            if columns and row is not None:
+                changed[row] = columns
+
+        # Only emit dataChanged() for what actually changed, since the range
+        # between scattered rows can be big and would be repainted.
+        for row, amount in util.contiguous_chunks(changed.keys()):
+            columns = []
+            for r in range(row, row + amount):
+                columns.extend(changed[r])
+            self.my_emit_dataChanged(row, row + amount - 1,
+                                     min(columns), max(columns))
 
     ##
 
@@ -548,10 +672,12 @@ class Playlist(QtCore.QAbstractTableModel):
             self.currently_playing.already_played = True
             minirok.Globals.engine.play(self.current_item.path)
 
-            if self.current_item.tags()['Length'] is None:
-                tags = tag_reader.TagReader.tags(self.current_item.path)
-                self.current_item.update_tags({'Length': tags.get('Length', 0)})
-                self.my_emit_dataChanged(self.current_item.position)
+            if self.current_item.tag('Length') is None:
+                tags = self.tag_reader.tags(self.current_item.path)
+                self.update_item_tags(self.current_item,
+                                      {'Length': tags.get('Length', 0)})
+                self.my_emit_dataChanged(
+                    self.position_of(self.current_item))
 
             self.emit(QtCore.SIGNAL('new_track'))
 
@@ -579,14 +705,14 @@ class Playlist(QtCore.QAbstractTableModel):
                 next = self.queue_popfront()
             elif self.random_mode:
                 try:
-                    next = self.random_queue.pop(0)
+                    next = self.random_queue.pop()
                 except IndexError:
                     next = None
                     self.maybe_populate_random_queue()
             elif self.current_item is self.FIRST_ITEM:
                 next = self.my_first_child()
             else:
-                index = self.current_item.position + 1
+                index = self.position_of(self.current_item) + 1
                 if index < self._row_count:
                     next = self._itemlist[index]
                 else:
@@ -597,7 +723,7 @@ class Playlist(QtCore.QAbstractTableModel):
 
             if next is None:
                 if self.random_mode:
-                    self.current_item = self.random_queue[0]
+                    self.current_item = self.random_queue.peek()
                 else:
                     self.current_item = self.FIRST_ITEM
             else:
@@ -608,7 +734,7 @@ class Playlist(QtCore.QAbstractTableModel):
 
     def slot_previous(self):
         if self.current_item not in (self.FIRST_ITEM, None):
-            index = self.current_item.position - 1
+            index = self.position_of(self.current_item) - 1
             if index >= 0:
                 self.current_item = self._itemlist[index]
                 if minirok.Globals.engine.status != engine.State.STOPPED:
@@ -647,6 +773,36 @@ class Playlist(QtCore.QAbstractTableModel):
     def removeItemsCmd(self, indexes):
         RemoveItemsCmd(self, [x.row() for x in indexes])
 
+    def prioritize_tags(self, indexes):
+        """Have the tag reader process these rows before any others.
+
+        The current item and the one that will be played after it are given
+        priority too, ahead of the passed rows.
+        """
+        items = []
+        current = self.current_item
+
+        if current not in (self.FIRST_ITEM, None):
+            items.append(current)
+
+        if self.queue:
+            items.append(self.queue[0])
+        elif current is self.FIRST_ITEM:
+            items.append(self._itemlist[0])
+        elif (current is not None and not self.random_mode
+              and self.position_of(current) + 1 < self._row_count):
+            items.append(self._itemlist[self.position_of(current) + 1])
+
+        items.extend(self._itemlist[x.row()] for x in indexes)
+        self.tag_reader.prioritize(x for x in items if x.needs_tag_reader)
+
+    def search_text(self, row):
+        """Return the (lowercased) text the filter matches a row against."""
+        return self._itemlist[row].search_text
+
+    def search_texts(self):
+        return [item.search_text for item in self._itemlist]
+
     ##
 
     def toggle_stop_after_item(self, item):
@@ -719,7 +875,7 @@ class Playlist(QtCore.QAbstractTableModel):
         """Return the first item to be played, honouring random_mode."""
         if self.random_mode:
             self.maybe_populate_random_queue()
-            return self.random_queue.pop(0)
+            return self.random_queue.pop()
         else:
             return self._itemlist[0]
 
@@ -752,20 +908,119 @@ class Playlist(QtCore.QAbstractTableModel):
     ##
 
     def save_config(self):
-        """Saves the current playlist."""
-        paths = (item.path for item in self._itemlist)
+        """Saves the current playlist.
+
+        Besides the paths, the tags of each item are saved, as well as the
+        queue, the current item and the stop-after item, so that the playlist
+        can be restored without touching the disk.
+
+        Nothing is saved while the playlist from older versions is still being
+        loaded, so that it is not replaced with part of it.
+        """
+        if self._legacy_load in self._add_operations:
+            minirok.logger.warning('not saving playlist: the saved playlist '
+                                   'was still being loaded')
+            return
+
+        items = self._itemlist
+        entries = [(item.path, item.saved_tags(), item.needs_tag_reader)
+                   for item in items]
+        queue = [self.position_of(item) for item in self.queue]
+
+        current = self.currently_playing or self.current_item
+        if current in (self.FIRST_ITEM, None):
+            current = None
+        else:
+            current = self.position_of(current)
+
+        if self.stop_after is not None:
+            stop_after = self.position_of(self.stop_after)
+        else:
+            stop_after = None
+
+        path = self.saved_playlist_path()
+        tmp_path = path + '.new'
 
         try:
-            playlist = open(self.saved_playlist_path(), 'w')
-        except IOError, e:
+            f = open(tmp_path, 'wb')
+            try:
+                cPickle.dump((self.SAVED_PLAYLIST_VERSION, entries, queue,
+                              current, stop_after,
+                              self.stop_mode is StopMode.AFTER_QUEUE),
+                             f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp_path, path)
+        except (IOError, OSError), e:
             minirok.logger.error('could not save playlist: %s', e)
         else:
-            playlist.write('\0'.join(paths))
-            playlist.close()
+            try:
+                os.unlink(self.legacy_saved_playlist_path())
+            except OSError:
+                pass
 
     def load_saved_playlist(self):
+        """Restore the playlist saved by save_config().
+
+        Files are not checked: if they disappeared, the engine will fail to
+        play them and the next track will be played instead. If there is no
+        saved playlist, the one from older versions (only a list of paths) is
+        loaded instead, if present.
+        """
+        try:
+            f = open(self.saved_playlist_path(), 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                self.load_legacy_saved_playlist()
+            else:
+                minirok.logger.warning('error opening saved playlist: %s', e)
+            return
+
+        try:
+            try:
+                (version, entries, queue, current, stop_after,
+                 stop_after_queue) = cPickle.load(f)
+            except Exception, e:
+                minirok.logger.warning('could not load saved playlist: %s', e)
+                return
+        finally:
+            f.close()
+
+        if version != self.SAVED_PLAYLIST_VERSION:
+            minirok.logger.warning('discarding saved playlist with version %r',
+                                   version)
+            return
+
+        items = [PlaylistItem.from_saved(*entry) for entry in entries]
+        valid_row = lambda row: row is not None and 0 <= row < len(items)
+
+        if items:
+            self.insert_items(0, items)
+
+        if queue:
+            rows = set()
+            queued = []
+            for row in queue:
+                if valid_row(row) and row not in rows:
+                    rows.add(row)
+                    queued.append(items[row])
+            self.toggle_enqueued_many_items(queued)
+
+        if valid_row(stop_after):
+            self.stop_after = items[stop_after]
+            if stop_after_queue:
+                self.stop_mode = StopMode.AFTER_QUEUE
+            else:
+                self.stop_mode = StopMode.AFTER_ONE
+
+        if valid_row(current):
+            self.current_item = items[current]
+
+        self.slot_list_changed()
+
+    def load_legacy_saved_playlist(self):
         try:
-            playlist = open(self.saved_playlist_path())
+            playlist = open(self.legacy_saved_playlist_path())
         except IOError, e:
             if e.errno == errno.ENOENT:
                 pass
@@ -774,16 +1029,24 @@ class Playlist(QtCore.QAbstractTableModel):
         else:
             files = re.split(r'\0+', playlist.read())
             if files != ['']:  # That'd be an empty saved playlist.
-                # add_files_untrusted() will use InsertItemsCmd, and that
+                # add_files_untrusted() would create an undo step, and that
                 # wouldn't be appropriate here: cook up the code ourselves.
-                self.insert_items(
-                    0, map(self.create_item,
-                           util.playable_from_untrusted(files, warn=True)))
+                operation = self._legacy_load = self.begin_add(undoable=False)
+                self.path_walker.walk(
+                    files,
+                    lambda paths: self.extend_add(operation, paths),
+                    lambda: self.end_add(operation),
+                    warn=True)
 
         self.slot_list_changed()
 
     @staticmethod
     def saved_playlist_path():
+        appdata = str(kdecore.KGlobal.dirs().saveLocation('appdata'))
+        return os.path.join(appdata, 'saved_playlist')
+
+    @staticmethod
+    def legacy_saved_playlist_path():
         appdata = str(kdecore.KGlobal.dirs().saveLocation('appdata'))
         return os.path.join(appdata, 'saved_playlist.txt')
 
@@ -793,20 +1056,127 @@ class Playlist(QtCore.QAbstractTableModel):
         """Add the given files to the playlist at a given position.
 
         If position is < 0, files will be added at the end of the playlist.
-        """
-        if position < 0:
-            position = self._row_count
 
+        Items for the first files are created and inserted right away; the
+        rest are created in a separate thread, and inserted in chunks as they
+        are ready, emitting "add_progress" signals with the number of items
+        added and to add. The whole operation is a single undo step.
+        """
         if files:
-            items = map(self.create_item, files)
-            InsertItemsCmd(self, position, items)
+            operation = self.begin_add(position)
+            self.extend_add(operation, files)
+            self.end_add(operation)
+
+    def add_files_untrusted(self, files, clear_playlist=False, position=-1,
+                            warn=True):
+        """Add to the playlist those files that exist and are playable.
 
-    def add_files_untrusted(self, files, clear_playlist=False):
-        """Add to the playlist those files that exist and are playable."""
+        Files are checked (and directories read) in other threads, and added
+        as with add_files() while they are found.
+        """
         if clear_playlist:
             self.slot_clear()
 
-        self.add_files(util.playable_from_untrusted(files, warn=True))
+        operation = self.begin_add(position)
+        self.path_walker.walk(files,
+                              lambda paths: self.extend_add(operation, paths),
+                              lambda: self.end_add(operation),
+                              warn=warn)
+
+    def begin_add(self, position=-1, undoable=True):
+        """Start an operation to add files, to be fed with extend_add().
+
+        Unless undoable is False, a single undo step is created for all the
+        items, pushed when the first ones are inserted (so that it comes
+        before any later edits), and extended as the rest arrive.
+        """
+        if position < 0:
+            position = None
+
+        operation = _AddFilesOperation(position, undoable)
+        self._add_operations.append(operation)
+        return operation
+
+    def extend_add(self, operation, files):
+        """Add more files to an operation started with begin_add()."""
+        size = _AddFilesOperation.CHUNK_SIZE
+
+        if operation.cancelled:
+            return
+        elif operation.pending == 0:
+            # Nothing is waiting in item_creator: insert the first files now,
+            # so that callers find them in the playlist without waiting.
+            operation.total += min(len(files), size)
+            self.insert_created_items(operation,
+                                      map(self.create_item, files[:size]))
+            files = files[size:]
+
+        chunks = [_AddFilesChunk(operation, files[i:i+size])
+                  for i in range(0, len(files), size)]
+
+        if chunks:
+            operation.total += len(files)
+            operation.pending += len(chunks)
+            self.item_creator.queue_many(chunks)
+
+        self.emit_add_progress()
+
+    def end_add(self, operation):
+        """Signal that no more files will be added to the operation."""
+        operation.open = False
+        self.maybe_finish_add(operation)
+        self.emit_add_progress()
+
+    def maybe_finish_add(self, operation):
+        if not operation.open and operation.pending == 0:
+            self._add_operations.remove(operation)
+
+    def slot_insert_created_items(self):
+        for chunk, items in self.item_creator.pop_done():
+            operation = chunk.operation
+            if not operation.cancelled:
+                self.insert_created_items(operation, items)
+            operation.pending -= 1
+            self.maybe_finish_add(operation)
+
+        self.emit_add_progress()
+
+    def insert_created_items(self, operation, items):
+        """Insert items of an add operation after the ones already added.
+
+        (Rows may have been added or removed while it was in progress.)
+        """
+        position = None
+
+        if operation.items:
+            last = self.position_of(operation.items[-1])
+            if last is not None:
+                position = last + 1
+
+        if position is None:
+            if operation.position is None:
+                position = self._row_count
+            else:
+                position = min(operation.position, self._row_count)
+
+        if items:
+            self.insert_items(position, items)
+            operation.items.extend(items)
+            if operation.undoable:
+                if operation.command is None:
+                    operation.command = AddFilesCmd(self, operation)
+                else:
+                    operation.command.update_text()
+
+    def emit_add_progress(self):
+        """Emit "add_progress" with the items added and to add so far.
+
+        Once all add operations are finished, both are 0.
+        """
+        operations = [op for op in self._add_operations if not op.cancelled]
+        added = sum(len(op.items) for op in operations)
+        total = sum(op.total for op in operations)
+        self.emit(QtCore.SIGNAL('add_progress'), added, total)
 
     def create_item(self, path):
         tags = self.tags_from_filename(path)
@@ -873,11 +1243,12 @@ class Playlist(QtCore.QAbstractTableModel):
 
     """Misc. helpers."""
 
-    def my_emit_dataChanged(self, row1, row2=None, column=None):
+    def my_emit_dataChanged(self, row1, row2=None, column=None, column2=None):
         """Emit dataChanged() between sorted([row1, row2]).
 
         If :param row2: is None, it will default to row1.
-        If :param column: is not None, only include that column in the signal.
+        If :param column: is not None, only include that column in the signal,
+            or the range between column and :param column2: if given.
         """
         if row2 is None:
             row2 = row1
@@ -887,8 +1258,10 @@ class Playlist(QtCore.QAbstractTableModel):
         if column is None:
             col1 = 0
             col2 = self.columnCount() - 1
-        else:
+        elif column2 is None:
             col1 = col2 = column
+        else:
+            col1, col2 = column, column2
 
         self.emit(
             QtCore.SIGNAL(
@@ -951,6 +1324,14 @@ class Proxy(proxy.Model):
 
     ##
 
+    def row_text(self, row, parent):
+        return self.sourceModel().search_text(row)
+
+    def row_texts(self):
+        return self.sourceModel().search_texts()
+
+    ##
+
     @proxy._map
     def toggle_enqueued(self, index):
         pass
@@ -971,6 +1352,10 @@ class Proxy(proxy.Model):
     def toggle_enqueued_many(self, indexes):
         pass
 
+    @proxy._map_many
+    def prioritize_tags(self, indexes):
+        pass
+
 ##
 
 class RepeatMode:
@@ -1056,6 +1441,19 @@ class PlaylistView(QtGui.QTreeView):
             'action_enqueue_dequeue_selected', 'Enqueue/dequeue selection',
             self.slot_enqueue_dequeue_selected, None, 'Ctrl+E')
 
+        # Rows on screen get their tags read first; the timer coalesces the
+        # many signals we get when scrolling or adding items.
+        self.prioritize_timer = QtCore.QTimer(self)
+        self.prioritize_timer.setSingleShot(True)
+
+        self.connect(self.prioritize_timer,
+                     QtCore.SIGNAL('timeout()'),
+                     self.slot_prioritize_visible)
+
+        self.connect(self.verticalScrollBar(),
+                     QtCore.SIGNAL('valueChanged(int)'),
+                     lambda: self.prioritize_timer.start(100))
+
     def setModel(self, playlist):
         QtGui.QTreeView.setModel(self, playlist)
         self.header().setup_from_config()
@@ -1077,6 +1475,12 @@ class PlaylistView(QtGui.QTreeView):
                      QtCore.SIGNAL('scroll_needed'),
                      lambda index: self.scrollTo(index))
 
+        for signal in ['rowsInserted(const QModelIndex &, int, int)',
+                       'layoutChanged()', 'modelReset()']:
+            self.connect(playlist,
+                         QtCore.SIGNAL(signal),
+                         lambda *args: self.prioritize_timer.start(100))
+
     ##
 
     def uniqSelectedIndexes(self):
@@ -1194,47 +1598,112 @@ class PlaylistView(QtGui.QTreeView):
     def slot_enqueue_dequeue_selected(self):
         self.model().toggle_enqueued_many(sorted(self.uniqSelectedIndexes()))
 
+    def slot_prioritize_visible(self):
+        model = self.model()
+        rect = self.viewport().rect()
+        first = self.indexAt(rect.topLeft())
+
+        if not first.isValid():
+            return  # Nothing visible.
+
+        last = self.indexAt(rect.bottomLeft())
+        if last.isValid():
+            last = last.row()
+        else:
+            last = model.rowCount() - 1
+
+        model.prioritize_tags([model.index(row, 0)
+                               for row in range(first.row(), last + 1)])
+
 ##
 
+# A single copy of each artist and album name is kept, shared by all items
+# that have it. (The builtin intern() does not accept unicode objects.)
+_interned_tags = {}
+
+
 class PlaylistItem(object):
 
     # This class should be considered sort of private to the model
 
     ALLOWED_TAGS = ['Track', 'Artist', 'Album', 'Title', 'Length']
 
+    TAG_INDEX = dict((tag, i) for i, tag in enumerate(ALLOWED_TAGS))
+    LENGTH_INDEX = TAG_INDEX['Length']
+
+    # Tags whose values are shared among many items.
+    INTERNED_TAGS = set(['Artist', 'Album'])
+
+    # Playlists can hold many items, so keep them small.
+    __slots__ = [
+        'path',
+        'search_text',
+        'queue_position',
+        'already_played',
+        'needs_tag_reader',
+        '_tags',  # A list with the value of each tag, in ALLOWED_TAGS order.
+        '_position',  # See Playlist.position_of().
+        '_generation',
+    ]
+
     def __init__(self, path, tags=None):
         self.path = path
 
-        self._tags = dict((tag, None) for tag in self.ALLOWED_TAGS)
+        self._tags = [None] * len(self.ALLOWED_TAGS)
+        self.search_text = u''
 
         if tags is not None:
             self.update_tags(tags)
 
         # these are maintained up to date by the model
-        self.position = None
+        self._position = None
+        self._generation = 0
         self.queue_position = None
         self.already_played = False
         self.needs_tag_reader = True
 
     ##
 
+    @classmethod
+    def from_saved(cls, path, saved_tags, needs_tag_reader):
+        """Create an item from the values saved by Playlist.save_config()."""
+        item = cls(path, dict((tag, value) for tag, value
+                              in zip(cls.ALLOWED_TAGS, saved_tags)
+                              if value is not None))
+        item.needs_tag_reader = needs_tag_reader
+        return item
+
+    def saved_tags(self):
+        """Return the tags of this item as a tuple, in ALLOWED_TAGS order."""
+        return tuple(self._tags)
+
     def tags(self):
-        return self._tags.copy()
+        """Return a new dict with the tags of this item."""
+        return dict(zip(self.ALLOWED_TAGS, self._tags))
+
+    def tag(self, tag):
+        """Return the value of a single tag, without copying all of them."""
+        return self._tags[self.TAG_INDEX[tag]]
 
     def tag_text(self, tag):
-        value = self._tags[tag]
+        return self.tag_by_index(self.TAG_INDEX[tag])
+
+    def tag_by_index(self, index):
+        value = self._tags[index]
 
-        if tag == 'Length' and value is not None:
+        if index == self.LENGTH_INDEX and value is not None:
             return util.fmt_seconds(value)
         else:
             return value
 
-    def tag_by_index(self, index):
-        return self.tag_text(self.ALLOWED_TAGS[index])
-
     def update_tags(self, tags):
+        """Update tags from a dict, returning the columns that changed."""
+        changed = []
+
         for tag, value in tags.items():
-            if tag not in self._tags:
+            try:
+                index = self.TAG_INDEX[tag]
+            except KeyError:
                 minirok.logger.warn('unknown tag %s', tag)
                 continue
             if tag == 'Track':
@@ -1249,8 +1718,23 @@ class PlaylistItem(object):
                 except ValueError:
                     minirok.logger.warn('invalid length: %r', value)
                     continue
+            elif tag in self.INTERNED_TAGS and value is not None:
+                value = _interned_tags.setdefault(value, value)
+
+            if self._tags[index] != value:
+                self._tags[index] = value
+                changed.append(index)
+
+        if changed:
+            self._update_search_text()
 
-            self._tags[tag] = value
+        return changed
+
+    def _update_search_text(self):
+        """Compute the lowercased text the playlist filter matches against."""
+        texts = map(self.tag_by_index, range(len(self.ALLOWED_TAGS)))
+        self.search_text = u' '.join(
+            unicode(text) for text in texts if text is not None).lower()
 
     ##
 
@@ -1471,6 +1955,33 @@ class Columns(QtGui.QHeaderView):
 
 ##
 
+class _AddFilesOperation(object):
+    """The state of an operation started with Playlist.begin_add()."""
+
+    CHUNK_SIZE = 500
+
+    def __init__(self, position, undoable):
+        self.position = position  # None means at the end of the playlist.
+        self.undoable = undoable
+        self.open = True  # Whether more files may come.
+        self.cancelled = False
+        self.total = 0  # Files received so far.
+        self.items = []  # Items inserted so far.
+        self.pending = 0  # Chunks not yet inserted.
+        self.command = None  # The AddFilesCmd, once items are inserted.
+
+
+class _AddFilesChunk(object):
+    """A list of paths whose items will be created by Playlist.item_creator."""
+
+    __slots__ = ['operation', 'paths']
+
+    def __init__(self, operation, paths):
+        self.operation = operation
+        self.paths = paths
+
+##
+
 """Undoable commands to modify the contents of the playlist.
 
 Note that they will add themselves to the model's QUndoStack.
@@ -1595,6 +2106,42 @@ class InsertItemsCmd(QtGui.QUndoCommand, AlterItemlistMixin):
         self.insert_items()
 
 
+class AddFilesCmd(QtGui.QUndoCommand, AlterItemlistMixin):
+    """Command for the items of an add operation (see Playlist.begin_add()).
+
+    The command is pushed once the first items are already in the playlist,
+    and the operation keeps inserting items after that. Undoing it cancels
+    the operation, if still in progress, and removes the items inserted so
+    far, wherever they are now.
+    """
+    def __init__(self, model, operation):
+        QtGui.QUndoCommand.__init__(self)
+        AlterItemlistMixin.__init__(self, model)
+        self.operation = operation
+        self.update_text()
+        self.model.undo_stack.push(self)
+
+    def update_text(self):
+        self.setText('insert ' + _n_tracks_str(len(self.operation.items)))
+
+    def undo(self):
+        operation = self.operation
+
+        if not self.chunks:
+            # First undo: stop the operation, and find its items.
+            operation.cancelled = True
+            rows = [self.model.position_of(item) for item in operation.items]
+            self.chunks = util.contiguous_chunks(
+                [row for row in rows if row is not None])
+            self.model.emit_add_progress()
+
+        self.remove_items()
+
+    def redo(self):
+        if self.chunks:  # Not the first time, called by QUndoStack.push().
+            self.insert_items()
+
+
 class RemoveItemsCmd(QtGui.QUndoCommand, AlterItemlistMixin):
     """Command to remove a list of rows from the playlist."""
 
@@ -33,6 +33,15 @@ class Preferences(kdeui.KConfigSkeleton):
         self._tag_regex = self.addItemString('TagRegex',
                                              self._tag_regex_value, '')
         self._tag_regex_mode = self.addItemInt('TagRegexMode', 0, 0)
+        # Not exposed in the dialog: the default should be good for most
+        # storage, but high-latency network filesystems can use more threads.
+        self._tag_reader_threads = self.addItemInt('TagReaderThreads', 4, 4)
+        # Also not exposed: parse tags in worker processes instead of threads.
+        self._tag_reader_processes = self.addItemBool(
+            'TagReaderProcesses', False, False)
+        # Nor this: read files sorted by directory and inode number.
+        self._tag_reader_disk_order = self.addItemBool(
+            'TagReaderDiskOrder', False, False)
 
         self.lastfm = LastfmPreferences(self)
         self.readConfig()
@@ -61,6 +70,18 @@ class Preferences(kdeui.KConfigSkeleton):
                                  self._tag_regex_mode.property().toString())
             return _dict[0]
 
+    @property
+    def tag_reader_threads(self):
+        return max(1, self._tag_reader_threads.value())
+
+    @property
+    def tag_reader_processes(self):
+        return self._tag_reader_processes.value()
+
+    @property
+    def tag_reader_disk_order(self):
+        return self._tag_reader_disk_order.value()
+
 ##
 
 class LastfmPreferences(object):
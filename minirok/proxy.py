@@ -8,7 +8,7 @@ import minirok
 
 import re
 
-from PyQt4 import QtGui
+from PyQt4 import QtCore, QtGui
 
 from minirok import (
     util,
@@ -27,50 +27,181 @@ class Model(QtGui.QSortFilterProxyModel):
       * patterns will be split into words, and an item will match if it
         matches (either as full words or subwords) *all* the words in pattern,
         in any order.
+
+    The rows accepted with the current pattern are remembered, so that when
+    the pattern is refined (e.g. the user types more characters), rows that
+    were rejected are not tested again; and when it is broadened, neither are
+    the rows that were accepted. Only toplevel rows are tracked, and any change
+    in the number or order of rows in the source model forgets them.
+
+    Subclasses can make filtering cheaper by reimplementing row_text() and
+    row_texts(), e.g. to return text precomputed by the source model.
     """
     def __init__(self, parent=None):
         QtGui.QSortFilterProxyModel.__init__(self, parent)
 
         self.pattern = None
+        self.words = []
         self.regexes = []
 
+        self._accepted = None  # Rows accepted with the current pattern.
+        self._previous = None  # Rows accepted with the previous one.
+        self._refining = False
+        self._dirty = set()  # Rows changed since they were last tested.
+        self._precomputed = False
+
+    def setSourceModel(self, model):
+        QtGui.QSortFilterProxyModel.setSourceModel(self, model)
+
+        for signal in ['rowsInserted(const QModelIndex &, int, int)',
+                       'rowsRemoved(const QModelIndex &, int, int)',
+                       'layoutChanged()', 'modelReset()']:
+            self.connect(model, QtCore.SIGNAL(signal), self._forget_rows)
+
+        self.connect(
+            model,
+            QtCore.SIGNAL(
+                'dataChanged(const QModelIndex &, const QModelIndex &)'),
+            self._slot_data_changed)
+
     def setPattern(self, pattern):
         pystring = unicode(pattern).strip()
+        old_words = self.words
+        accepted = self._accepted
 
         if pystring:
             if pystring != self.pattern:
                 self.pattern = pystring
+                self.words = pystring.lower().split()
                 self.regexes = [re.compile(re.escape(pat), re.I | re.U)
                                 for pat in pystring.split()]
         else:
             self.pattern = None
+            self.words = []
 
-        self.invalidateFilter()
+        self._previous = None
+
+        if accepted is not None and self.pattern is not None:
+            if util.query_refines(self.words, old_words):
+                self._previous = accepted
+                self._refining = True
+            elif util.query_refines(old_words, self.words):
+                self._previous = accepted
+                self._refining = False
+
+        if self.pattern is None:
+            self._accepted = None
+        else:
+            texts = self.row_texts()
+            if texts is None:
+                self._accepted = set()
+            else:
+                # Compute all matches now, in one pass over the list, instead
+                # of testing row by row from filterAcceptsRow().
+                self._accepted = self._accepted_rows(texts)
+                self._precomputed = True
+
+        try:
+            self.invalidateFilter()
+        finally:
+            self._previous = None
+            self._precomputed = False
+            self._dirty.clear()
 
     def filterAcceptsRow(self, row, parent):
         if self.pattern is None:
             return True
+        elif parent.isValid():
+            return self.row_matches(row, parent)
+        elif self._precomputed:
+            return row in self._accepted
+
+        if self._previous is None or row in self._dirty:
+            accept = self.row_matches(row, parent)
+        elif self._refining:
+            accept = (row in self._previous
+                      and self.row_matches(row, parent))
         else:
-            text = u''
-            role = self.filterRole()
-            model = self.sourceModel()
+            accept = (row in self._previous
+                      or self.row_matches(row, parent))
 
-            c = self.filterKeyColumn()
-            if c >= 0:
-                columns = [c]
-            else:
-                columns = range(model.columnCount(parent))
+        if accept and self._accepted is not None:
+            self._accepted.add(row)
+
+        return accept
+
+    def row_matches(self, row, parent):
+        text = self.row_text(row, parent)
+
+        for regex in self.regexes:
+            if not regex.search(text):
+                return False
+        else:
+            return True
 
-            for c in columns:
-                index = model.index(row, c, parent)
-                data = index.data(role)
-                text += unicode(data.toString())
+    def row_text(self, row, parent):
+        """Return the text to match the pattern against for a row."""
+        text = u''
+        role = self.filterRole()
+        model = self.sourceModel()
 
-            for regex in self.regexes:
-                if not regex.search(text):
-                    return False
+        c = self.filterKeyColumn()
+        if c >= 0:
+            columns = [c]
+        else:
+            columns = range(model.columnCount(parent))
+
+        for c in columns:
+            index = model.index(row, c, parent)
+            data = index.data(role)
+            text += unicode(data.toString())
+
+        return text
+
+    def row_texts(self):
+        """Return a list with the lowercased text of each toplevel row.
+
+        None can be returned if such list can't be computed cheaply, and rows
+        will be tested one by one in filterAcceptsRow() with row_text().
+        """
+        return None
+
+    ##
+
+    def _accepted_rows(self, texts):
+        """Return the set of rows whose text (from row_texts()) matches."""
+        words = self.words
+        previous = self._previous
+        rows = xrange(len(texts))
+
+        if previous is None:
+            accepted = set()
+            candidates = rows
+        elif self._refining:
+            accepted = set()
+            candidates = [row for row in previous | self._dirty
+                          if row < len(texts)]
+        else:
+            accepted = previous - self._dirty
+            candidates = [row for row in rows if row not in accepted]
+
+        for row in candidates:
+            text = texts[row]
+            for word in words:
+                if word not in text:
+                    break
             else:
-                return True
+                accepted.add(row)
+
+        return accepted
+
+    def _forget_rows(self, *args):
+        self._accepted = None
+        self._dirty.clear()
+
+    def _slot_data_changed(self, top_left, bottom_right):
+        if self._accepted is not None and not top_left.parent().isValid():
+            self._dirty.update(range(top_left.row(), bottom_right.row() + 1))
 
 ##
 
@@ -72,6 +72,10 @@ class StatusBar(kdeui.KStatusBar):
                      QtCore.SIGNAL('new_track'),
                      self.slot_start)
 
+        self.connect(minirok.Globals.playlist,
+                     QtCore.SIGNAL('add_progress'),
+                     self.slot_add_progress)
+
         self.connect(minirok.Globals.engine,
                      QtCore.SIGNAL('status_changed'),
                      self.slot_engine_status_changed)
@@ -106,6 +110,12 @@ class StatusBar(kdeui.KStatusBar):
         self.slider.setEnabled(True)
         self.slot_update()
 
+    def slot_add_progress(self, added, total):
+        if total:
+            self.showMessage('Adding tracks: %d of %d' % (added, total))
+        else:
+            self.clearMessage()
+
     def slot_stop(self):
         self.timer.stop()
         self.blink_timer.stop()
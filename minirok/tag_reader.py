@@ -6,59 +6,368 @@
 
 import minirok
 
+import cPickle
+import errno
+import os
+
 import mutagen
-import mutagen.easyid3
-import mutagen.id3
 import mutagen.mp3
 
+try:
+    import multiprocessing
+except ImportError:
+    _has_multiprocessing = False
+else:
+    _has_multiprocessing = True
+
+from PyKDE4 import kdecore
+from PyQt4 import QtCore
+
 from minirok import (
     util,
 )
 
 ##
 
-class TagReader(util.ThreadedWorker):
-    """Worker to read tags from files."""
+APPDATA_TAG_CACHE = 'tag_cache'
+
+ID3_FRAMES = {
+    'Track': 'TRCK',
+    'Artist': 'TPE1',
+    'Album': 'TALB',
+    'Title': 'TIT2',
+}
+
+# mutagen.File() accepts file objects, and not only paths, since 1.33.
+_MUTAGEN_TAKES_FILEOBJ = getattr(mutagen, 'version', (0,)) >= (1, 33)
+
+##
+
+class TagReader(util.ThreadedWorkerPool):
+    """Worker to read tags from files.
+
+    If processes is True and start_process_pool() was called, tags will be
+    parsed in its pool of worker processes, so that parsing does not compete
+    with the GUI thread for the interpreter lock. Threads then only consult
+    the cache and wait for the processes. If the pool stops working, tags are
+    read in the threads.
+
+    If disk_order is True, files will be read in batches sorted by directory
+    and inode number, which is much closer to the order of the data on disk
+    than the order of the playlist (less seeking on rotational disks).
+    """
+    # Worker processes are replaced after reading this many files, once no
+    # files are being read, so that any memory they accumulate is given back.
+    PROCESS_MAX_TASKS = 1000
+    PROCESS_TIMEOUT = 60  # In seconds.
+
+    def __init__(self, threads=1, processes=False, disk_order=False):
+        util.ThreadedWorkerPool.__init__(
+            self, lambda item: self.tags(item.path), threads)
+
+        if disk_order:
+            self.order_key = _disk_order_key
+
+        self.process_pool = None
+        self._process_count = threads
+        self._process_tasks = 0  # Approximate: updated without locking.
+
+        if processes:
+            if _process_pool is not None:
+                self.process_pool = _process_pool
+                self.connect(self, QtCore.SIGNAL('items_ready'),
+                             self._slot_maybe_recycle_process_pool)
+            else:
+                minirok.logger.info('tag reader processes not started, '
+                                    'reading tags in threads')
 
-    def __init__(self):
-        util.ThreadedWorker.__init__(self, lambda item: self.tags(item.path))
+        appdata = str(kdecore.KGlobal.dirs().saveLocation('appdata'))
+        self.cache = TagCache(os.path.join(appdata, APPDATA_TAG_CACHE))
+        util.CallbackRegistry.register_save_config(self.cache.save)
+        util.CallbackRegistry.register_save_config(_log_io_stats)
 
     ##
 
-    @staticmethod
-    def tags(path):
-        """Return a dict with the tags read from the given path.
+    def tags(self, path):
+        """Return a dict with the tags for the given path.
 
-        Tags that will be read: Track, Artist, Album, Title, Length. Any of
-        these may be missing in the returned dict.
+        The tag cache is consulted first; if the file is not there, or it
+        changed since it was cached, tags will be read with read_tags().
         """
         try:
-            info = mutagen.File(path)
-            if isinstance(info, mutagen.mp3.MP3):
-                # We really want an EasyID3 object, so we re-read the tags now.
-                # Alas, EasyID3 does not include the .info part, which contains
-                # the length, so we save it from the MP3 object.
-                dot_info = info.info
-                try:
-                    info = mutagen.easyid3.EasyID3(path)
-                except mutagen.id3.ID3NoHeaderError:
-                    info = mutagen.easyid3.EasyID3()
-                info.info = dot_info
-            elif info is None:
-                minirok.logger.warning(
-                    'could not read tags from %s: mutagen.File() returned None',
-                    path)
-                return {}
-        except Exception, e:
-            if path in str(e):  # Mutagen included the path in the exception.
-                msg = 'could not read tags: %s' % e
+            st = os.stat(path)
+        except OSError:
+            st = None  # Let read_tags() report the error.
+        else:
+            tags = self.cache.get(path, st)
+            if tags is not None:
+                return tags
+
+        tags = self._read_tags(path)
+
+        if tags and st is not None:
+            self.cache.put(path, st, tags)
+
+        return tags
+
+    def _read_tags(self, path):
+        """Read tags with read_tags(), in a worker process if possible."""
+        pool = self.process_pool
+
+        if pool is not None:
+            self._process_tasks += 1
+            try:
+                result = pool.apply_async(_read_tags_quietly, (path,)).get(
+                    self.PROCESS_TIMEOUT)
+            except multiprocessing.TimeoutError:
+                minirok.logger.warn('timeout reading tags from %s in a '
+                                    'worker process', path)
+            except Exception, e:
+                if pool is self.process_pool:  # Else, it was just recycled.
+                    # _read_tags_quietly() does not raise, so the pool itself
+                    # is broken.
+                    minirok.logger.warn('tag reader processes failed, reading '
+                                        'tags in threads from now on: %s', e)
+                    self.process_pool = None
             else:
-                msg = 'could not read tags from %s: %s' % (path, e)
-            minirok.logger.warning(msg)
-            return {}
+                return _report_read(*result)
+
+        return read_tags(path)
+
+    def _slot_maybe_recycle_process_pool(self):
+        """Replace the process pool if due, and no files are being read.
+
+        This is done here, rather than with the maxtasksperchild argument of
+        the pool, so that processes are not forked at any random time.
+        """
+        pool = self.process_pool
+
+        if (pool is not None and self._process_tasks >= self.PROCESS_MAX_TASKS
+                and self.is_idle()):
+            self.process_pool = None
+            self._process_tasks = 0
+            pool.close()
+            pool.join()
+            self.process_pool = _create_process_pool(self._process_count)
+
+##
+
+_process_pool = None
+
+def start_process_pool(processes):
+    """Start the pool of worker processes for TagReader.
+
+    This must be called before any other thread is started: a process forked
+    while another thread holds a lock (e.g. one of the logging module's)
+    would deadlock if it tried to take it.
+    """
+    global _process_pool
+    _process_pool = _create_process_pool(processes)
+
+
+def _create_process_pool(processes):
+    """Return a multiprocessing.Pool, or None if it can't be created."""
+    if not _has_multiprocessing:
+        minirok.logger.info('multiprocessing not available, '
+                            'reading tags in threads')
+        return None
+
+    try:
+        return multiprocessing.Pool(processes)
+    except Exception, e:
+        minirok.logger.warn('could not start tag reader processes, '
+                            'reading tags in threads: %s', e)
+        return None
+
+##
+
+class TagCache(object):
+    """A persistent cache of tags, keyed by path.
+
+    Entries are only considered valid if the size and mtime of the file are
+    the same as when its tags were stored. The cache is kept in memory, and
+    written to disk with save(); when it grows over MAX_ENTRIES, the least
+    recently used entries are evicted.
+    """
+    VERSION = 1
+    MAX_ENTRIES = 50000
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}  # path -> (size, mtime, tags, stamp)
+        self._stamp = 0
+        self._mutex = QtCore.QMutex()
+        self.load()
+
+    ##
+
+    @util.needs_lock('_mutex')
+    def get(self, path, st):
+        """Return a copy of the cached tags for path, or None.
+
+        Args:
+          st: the result of os.stat(path).
+        """
+        try:
+            size, mtime, tags, stamp = self._entries[path]
+        except KeyError:
+            return None
+
+        if size != st.st_size or mtime != st.st_mtime:
+            del self._entries[path]
+            return None
+
+        self._stamp += 1
+        self._entries[path] = (size, mtime, tags, self._stamp)
+        return tags.copy()
+
+    @util.needs_lock('_mutex')
+    def put(self, path, st, tags):
+        self._stamp += 1
+        self._entries[path] = (st.st_size, st.st_mtime, tags.copy(),
+                               self._stamp)
+
+        if len(self._entries) > self.MAX_ENTRIES * 1.1:
+            self._evict()
+
+    ##
+
+    @util.needs_lock('_mutex')
+    def load(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                minirok.logger.warn('could not open tag cache: %s', e)
+            return
+
+        try:
+            try:
+                version, stamp, entries = cPickle.load(f)
+            except Exception, e:
+                minirok.logger.warn('could not load tag cache: %s', e)
+                return
+        finally:
+            f.close()
+
+        if version != self.VERSION:
+            minirok.logger.info('discarding tag cache with version %r', version)
+        else:
+            self._stamp = stamp
+            self._entries = entries
 
-        tags = {}
+    @util.needs_lock('_mutex')
+    def save(self):
+        self._evict()
+        tmp_path = self.path + '.new'
 
+        try:
+            f = open(tmp_path, 'wb')
+            try:
+                cPickle.dump((self.VERSION, self._stamp, self._entries), f,
+                             cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError), e:
+            minirok.logger.error('could not save tag cache: %s', e)
+
+    ##
+
+    def _evict(self):
+        """Drop the least recently used entries over MAX_ENTRIES.
+
+        The caller must hold the mutex.
+        """
+        excess = len(self._entries) - self.MAX_ENTRIES
+
+        if excess > 0:
+            by_stamp = sorted(self._entries.iteritems(),
+                              key=lambda (path, entry): entry[3])
+            for path, entry in by_stamp[:excess]:
+                del self._entries[path]
+
+##
+
+def _disk_order_key(item):
+    """Return a key to sort items in (approximate) on-disk order."""
+    dirname = os.path.dirname(item.path)
+
+    try:
+        return (dirname, os.stat(item.path).st_ino)
+    except OSError:
+        return (dirname, 0)
+
+
+def read_tags(path):
+    """Return a dict with the tags read from the given path.
+
+    Tags that will be read: Track, Artist, Album, Title, Length. Any of
+    these may be missing in the returned dict.
+
+    If mutagen supports it, the file is read through a BlockCachedFile, and
+    the I/O done is accounted per format (see _account_io()).
+    """
+    return _report_read(*_read_tags_quietly(path))
+
+
+def _report_read(tags, warnings, io):
+    """Log the warnings and account the I/O of _read_tags_quietly()."""
+    for msg in warnings:
+        minirok.logger.warning(msg)
+
+    if io is not None:
+        _account_io(*io)
+
+    return tags
+
+
+def _read_tags_quietly(path):
+    """Read tags like read_tags(), returning (tags, warnings, io).
+
+    Nothing is logged, and no locks are taken, so that this can run in a
+    process forked while other threads held them: warnings is a list of
+    messages, and io the arguments for _account_io(), or None.
+    """
+    fileobj = info = io = None
+    warnings = []
+
+    try:
+        try:
+            if _MUTAGEN_TAKES_FILEOBJ:
+                fileobj = BlockCachedFile(path)
+                info = mutagen.File(fileobj)
+            else:
+                info = mutagen.File(path)
+        finally:
+            if fileobj is not None:
+                fileobj.close()
+                io = (fileobj.name, fileobj.bytes_read, fileobj.reads,
+                      info is not None and type(info).__name__ or 'unknown')
+        if info is None:
+            warnings.append('could not read tags from %s: mutagen.File() '
+                            'returned None' % path)
+            return {}, warnings, io
+    except Exception, e:
+        if path in str(e):  # Mutagen included the path in the exception.
+            msg = 'could not read tags: %s' % e
+        else:
+            msg = 'could not read tags from %s: %s' % (path, e)
+        warnings.append(msg)
+        return {}, warnings, io
+
+    tags = {}
+
+    if isinstance(info, mutagen.mp3.MP3):
+        # Look at the ID3 frames directly: going through EasyID3 would
+        # mean opening and parsing the file a second time.
+        id3 = info.tags or {}
+        for column, frame in ID3_FRAMES.iteritems():
+            try:
+                tags[column] = id3[frame].text[0]
+            except (KeyError, IndexError):
+                pass  # Frame is not present in the file, or empty.
+    else:
         for column in ['Track', 'Artist', 'Album', 'Title']:
             if column == 'Track':
                 tag = 'tracknumber'
@@ -68,13 +377,137 @@ class TagReader(util.ThreadedWorker):
             try:
                 tags[column] = info[tag][0]
             except ValueError:
-                minirok.logger.warn('invalid tag %r for %s', tag, type(info))
+                warnings.append('invalid tag %r for %s' % (tag, type(info)))
             except KeyError:
                 pass  # Tag is not present in the file.
 
+    try:
+        tags['Length'] = int(info.info.length)
+    except AttributeError:
+        pass
+
+    return tags, warnings, io
+
+##
+
+class BlockCachedFile(object):
+    """A read-only file object that caches blocks, and counts the I/O done.
+
+    The underlying file is read in aligned blocks of BLOCK_SIZE bytes, and
+    the last CACHE_BLOCKS blocks are kept. Tag parsers do many small reads
+    and seeks around the headers and footers of a file (e.g. ID3v1 and APE
+    tags at the end, or the MP4 "moov" atom), and this way each region is
+    read only once, and the rest of the file is not read at all. Big reads
+    go directly to the file.
+    """
+    BLOCK_SIZE = 16384
+    CACHE_BLOCKS = 8
+
+    def __init__(self, path):
+        self.name = path
+        self.bytes_read = 0
+        self.reads = 0
+
+        self._file = open(path, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._pos = 0
+        self._blocks = {}  # index -> data
+        self._lru = []  # Indexes in _blocks, least recently used first.
+
+    ##
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._size - self._pos
+        else:
+            size = max(0, min(size, self._size - self._pos))
+
+        if size > self.BLOCK_SIZE * self.CACHE_BLOCKS / 2:
+            data = self._read_raw(self._pos, size)
+        else:
+            chunks = []
+            pos = self._pos
+            end = pos + size
+            while pos < end:
+                index, offset = divmod(pos, self.BLOCK_SIZE)
+                chunk = self._block(index)[offset:offset + end - pos]
+                if not chunk:
+                    break  # The file was truncated.
+                chunks.append(chunk)
+                pos += len(chunk)
+            data = ''.join(chunks)
+
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._size
+
+        if offset < 0:
+            raise IOError(errno.EINVAL, 'Invalid argument')
+
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._file.close()
+        self._blocks.clear()
+
+    ##
+
+    def _block(self, index):
         try:
-            tags['Length'] = int(info.info.length)
-        except AttributeError:
-            pass
+            data = self._blocks[index]
+        except KeyError:
+            data = self._blocks[index] = self._read_raw(
+                index * self.BLOCK_SIZE, self.BLOCK_SIZE)
+            if len(self._lru) >= self.CACHE_BLOCKS:
+                del self._blocks[self._lru.pop(0)]
+        else:
+            self._lru.remove(index)
 
-        return tags
+        self._lru.append(index)
+        return data
+
+    def _read_raw(self, offset, size):
+        self._file.seek(offset)
+        data = self._file.read(size)
+        self.reads += 1
+        self.bytes_read += len(data)
+        return data
+
+
+# format -> [files, bytes read, read calls]
+_io_stats = {}
+_io_stats_mutex = QtCore.QMutex()
+
+def _account_io(path, nbytes, reads, format):
+    """Log and accumulate the I/O done to read the tags of a file."""
+    minirok.logger.debug('read %d bytes in %d calls from %s (%s)',
+                         nbytes, reads, path, format)
+
+    _io_stats_mutex.lock()
+    try:
+        stats = _io_stats.setdefault(format, [0, 0, 0])
+        stats[0] += 1
+        stats[1] += nbytes
+        stats[2] += reads
+    finally:
+        _io_stats_mutex.unlock()
+
+
+def _log_io_stats():
+    """Log the I/O done per format to read tags in this process."""
+    _io_stats_mutex.lock()
+    try:
+        for format, (files, nbytes, reads) in sorted(_io_stats.iteritems()):
+            minirok.logger.debug(
+                'tags for %d %s files: %d bytes (%d per file), %d read calls',
+                files, format, nbytes, nbytes / files, reads)
+    finally:
+        _io_stats_mutex.unlock()
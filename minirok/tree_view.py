@@ -6,10 +6,27 @@
 
 import minirok
 
+import bisect
+import cPickle
+import errno
+import hashlib
 import os
-import re
 import stat
 
+try:
+    from scandir import scandir
+except ImportError:
+    _has_scandir = False
+else:
+    _has_scandir = True
+
+try:
+    import pyinotify
+except ImportError:
+    _has_pyinotify = False
+else:
+    _has_pyinotify = True
+
 from PyKDE4 import kdecore, kdeui
 from PyQt4 import QtCore, QtGui
 
@@ -21,20 +38,39 @@ from minirok import (
 
 ##
 
+APPDATA_TREE_CACHE = 'tree_cache'
+
+##
+
 class TreeView(QtGui.QTreeWidget):
 
     CONFIG_SECTION = 'Tree View'
     CONFIG_RECURSE_OPTION = 'RecurseScan'
 
+    SCAN_THREADS = 4
+
     def __init__(self, *args):
         QtGui.QTreeWidget.__init__(self, *args)
         self.root = None
+        self.scanning = False
         self.populating = False
-        self.populate_pending = []
-        self.empty_directories = set()
+        self.empty_directories = set()  # Paths, once a scan has finished.
         self.automatically_opened = set()
 
-        self.timer = QtCore.QTimer(self)
+        # Items are only created for directories the user opens, or that
+        # contain search results; this maps path -> DirectoryItem for those
+        # created so far.
+        self.directory_items = {}
+
+        # Directories are read in other threads; the results are stored in
+        # _my_listdir_cache and the search index in slot_scan_results(), in
+        # the main thread.
+        self.scanner = util.ThreadedWorkerPool(_scan_directory,
+                                               self.SCAN_THREADS)
+        self.scanner.start()
+
+        self.watcher = DirectoryWatcher(self)
+        self.search_index = SearchIndex()
 
         # Recursing the tree to enable the search widget is configurable;
         # the LeftSide communicates with us via the "recurse" property.
@@ -50,9 +86,17 @@ class TreeView(QtGui.QTreeWidget):
         self.setDragDropMode(self.DragOnly)
         self.setSelectionMode(QtGui.QAbstractItemView.ExtendedSelection)
 
-        self.connect(self.timer,
-                     QtCore.SIGNAL('timeout()'),
-                     self.slot_populate_done)
+        self.connect(self.scanner,
+                     QtCore.SIGNAL('items_ready'),
+                     self.slot_scan_results)
+
+        self.connect(self.watcher,
+                     QtCore.SIGNAL('directory_changed'),
+                     self.slot_directory_changed)
+
+        self.connect(self.watcher,
+                     QtCore.SIGNAL('directory_moved'),
+                     self.slot_directory_moved)
 
         self.connect(self,
                      QtCore.SIGNAL('itemActivated(QTreeWidgetItem *, int)'),
@@ -65,14 +109,13 @@ class TreeView(QtGui.QTreeWidget):
     ##
 
     def _set_recurse(self, value):
-        scanning = self.timer.isActive()
-        if scanning ^ value:
+        if self.scanning ^ value:
             self._recurse = bool(value)
             if self._recurse:
                 self.emit(QtCore.SIGNAL('scan_in_progress'), True)
-                self.timer.start(0)
+                self.start_scan()
             else:
-                self.timer.stop()
+                self.stop_scan()
 
     recurse = property(lambda self: self._recurse, _set_recurse)
 
@@ -137,25 +180,36 @@ class TreeView(QtGui.QTreeWidget):
         """
         if directory != self.root or self.populating:
             # Not refreshing
+            self.stop_scan()
+            self.watcher.clear()
+            self.search_index.reset(directory)
+            self.directory_items.clear()
             self.clear()
-            self.populate_pending = []
             self.setSortingEnabled(False)  # Dog slow otherwise.
             self.empty_directories.clear()
             self.automatically_opened.clear()
             self.root = directory
 
-        def _directory_children(parent):
-            return _get_children(parent, lambda x: x.IS_DIR)
-
         self.populating = True
+        self.watcher.watch(self.root)
+
+        if self._recurse:
+            _load_snapshot(self.root)
+
         _populate_tree(self.invisibleRootItem(), self.root)
+        from_cache = self._recurse and self.index_from_cache()
         self.sortItems(0, QtCore.Qt.AscendingOrder)  # (¹)
 
-        self.populate_pending = _directory_children(self.invisibleRootItem())
+        if from_cache:
+            # The index is complete, and search can be used already: the scan
+            # will only update the directories that changed since last time.
+            self.setSortingEnabled(True)
+            self.prune_empty_directories()
+        elif self._recurse:
+            self.emit(QtCore.SIGNAL('scan_in_progress'), True)
 
         if self._recurse:
-            self.timer.start(0)
-            self.emit(QtCore.SIGNAL('scan_in_progress'), True)
+            self.start_scan()
 
         # (¹) There seems to be a bug somewhere, that if setSortingEnabled(True)
         # is called, without calling some function like sortItems() where the
@@ -164,24 +218,297 @@ class TreeView(QtGui.QTreeWidget):
     def slot_refresh(self):
         self.slot_show_directory(self.root)
 
-    def slot_populate_done(self):
-        def _directory_children(parent):
-            return _get_children(parent, lambda x: x.IS_DIR)
+    def start_scan(self):
+        """Start reading recursively all directories under the root.
 
-        try:
-            item = self.populate_pending.pop(0)
-        except IndexError:
-            self.timer.stop()
+        Directories already read will only be read again if their mtime
+        changed. No items are created for them: the scan only fills
+        _my_listdir_cache and the search index.
+        """
+        self.scanning = True
+        pending = self.subdirectories(self.root)
+
+        if pending:
+            self.queue_scan(pending)
+        else:
+            self.slot_scan_results()  # Nothing to do, finish the scan.
+
+    def stop_scan(self):
+        self.scanning = False
+        self.scanner.clear_queue()
+
+    def queue_scan(self, paths):
+        for path in paths:
+            # Watch before reading, so that no change is missed.
+            self.watcher.watch(path)
+        self.scanner.queue_many(paths)
+
+    def index_from_cache(self):
+        """Fill the search index with the contents of _my_listdir_cache.
+
+        Nothing is read from disk. Returns True if all the directories under
+        the root were in the cache.
+        """
+        self.search_index.reset(self.root)
+        return self._index_entries(self.root, _listing_entries(self.root))
+
+    def prune_empty_directories(self):
+        """Remove directories without playable files from the tree.
+
+        Directories are found to be empty by looking at _my_listdir_cache;
+        items will not be created for them from now on.
+        """
+        self.empty_directories = _find_empty_directories(self.root)
+
+        for path in self.empty_directories:
+            item = self.directory_items.get(path)
+            if item is not None:
+                (item.parent() or self.invisibleRootItem()).removeChild(item)
+                self.forget_item(item)
+
+    def slot_scan_results(self):
+        prefix = os.path.join(self.root, '')
+
+        for path, listing in self.scanner.pop_done():
+            if not path.startswith(prefix):
+                continue  # The root changed in the meantime.
+            self.store_listing(path, listing)
+            self.watcher.mark_up_to_date(path)
+            item = self.directory_items.get(path)
+            if item is not None:
+                _populate_tree(item, path, read=False)
+            subdirectories = self.subdirectories(path)
+            if not self.scanning:
+                # Reading new directories found by the watcher: directories
+                # it knows did not change need not be read again.
+                subdirectories = [x for x in subdirectories
+                                  if not self.watcher.is_up_to_date(x)]
+            self.queue_scan(subdirectories)
+
+        self.materialize(self.search_index.pop_new_matches())
+
+        if self.scanning and self.scanner.is_empty():
+            self.scanning = False
             self.populating = False
             self.setSortingEnabled(True)
-            for item in self.empty_directories:
-                (item.parent() or self.invisibleRootItem()).removeChild(item)
-                del item  # NB: Is this necessary?
-            self.empty_directories.clear()
+            self.prune_empty_directories()
             self.emit(QtCore.SIGNAL('scan_in_progress'), False)
+
+    def slot_directory_changed(self, path):
+        """Update the contents of a directory the watcher saw change."""
+        self.read_directory(path)
+        self.watcher.mark_up_to_date(path)
+        item = self.find_directory_item(path)
+
+        if item is not None:
+            _populate_tree(item, path, read=False)
+            if item is not self.invisibleRootItem():
+                item.sortChildren(0, QtCore.Qt.AscendingOrder)
+
+        self.materialize(self.search_index.pop_new_matches())
+
+        if self._recurse:
+            # Read any new subdirectories as well.
+            self.queue_scan([x for x in self.subdirectories(path)
+                             if x not in _my_listdir_cache])
+
+    def slot_directory_moved(self, path):
+        """Forget a directory the watcher saw being moved away.
+
+        It is removed from its parent's listing, which is marked to be read
+        again (the watcher will report the parent as changed too). If a
+        directory with the same name is there by then, it will be found as a
+        new one.
+        """
+        if path == self.root:
+            return
+
+        self._unindex_tree(path)
+        self._forget_directory(path)
+
+        parent, entry = os.path.split(path)
+        entries = _listing_entries(parent)
+
+        if entry in entries:
+            entries = entries.copy()
+            del entries[entry]
+            _my_listdir_cache[parent] = (None, entries)  # No mtime: re-read.
+
+    def find_directory_item(self, path):
+        """Return the item for a directory path, or None if there is none.
+
+        The invisible root item is returned for the root directory. Note that
+        items are only created for directories as needed, see materialize().
+        """
+        if path == self.root:
+            return self.invisibleRootItem()
         else:
-            _populate_tree(item, item.path)
-            self.populate_pending.extend(_directory_children(item))
+            return self.directory_items.get(path)
+
+    def forget_item(self, item):
+        """Forget the DirectoryItems of a removed item and its descendants."""
+        pending = [item]
+
+        while pending:
+            item = pending.pop()
+            if item.IS_DIR:
+                self.directory_items.pop(item.path, None)
+                pending.extend(_get_children(item, lambda x: x.IS_DIR))
+
+    def materialize(self, paths):
+        """Make sure there are items for the given paths, and their parents.
+
+        Directories are populated from _my_listdir_cache, so nothing is read
+        from disk. Paths that cannot be reached in the tree (e.g., because
+        they are under a directory pruned as empty) are skipped.
+        """
+        populated = {}
+
+        for path in paths:
+            self._materialize_directory(os.path.dirname(path), populated)
+
+    def _materialize_directory(self, path, populated):
+        try:
+            return populated[path]
+        except KeyError:
+            pass
+
+        if path == self.root:
+            item = self.invisibleRootItem()
+        elif (self._materialize_directory(os.path.dirname(path), populated)
+              is not None):
+            item = self.directory_items.get(path)
+        else:
+            item = None
+
+        if item is not None and path in _my_listdir_cache:
+            _populate_tree(item, path, read=False)
+
+        populated[path] = item
+        return item
+
+    ##
+
+    def read_directory(self, path):
+        """Read a directory from disk into _my_listdir_cache.
+
+        Its contents will only be re-read from the filesystem if the mtime is
+        different to the mtime the last time they were read.
+        """
+        mtime = _my_listdir_cache.get(path, (None, None))[0]
+        self.store_listing(path, _read_directory(path, mtime))
+
+    def store_listing(self, path, listing):
+        """Store a listing in _my_listdir_cache, updating the search index."""
+        old_entries = _listing_entries(path)
+        _store_listing(path, listing)
+        new_entries = _listing_entries(path)
+
+        if old_entries is new_entries:
+            return  # Unchanged.
+
+        removed = [(os.path.join(path, entry), is_dir)
+                   for entry, is_dir in old_entries.iteritems()
+                   if new_entries.get(entry) != is_dir]
+        indexed = path == self.root or path in self.search_index
+
+        for entry_path, is_dir in removed:
+            if indexed:
+                self._unindex_tree(entry_path)
+            if is_dir:
+                self._forget_directory(entry_path)
+
+        if not indexed:
+            return  # Not in the tree.
+
+        added = dict((entry, is_dir)
+                     for entry, is_dir in new_entries.iteritems()
+                     if old_entries.get(entry) != is_dir)
+        self._index_entries(path, added)
+
+    def _forget_directory(self, path):
+        """Forget a directory that went away, and its subdirectories.
+
+        They are dropped from _my_listdir_cache, the watcher, the scanner and
+        empty_directories, so that a directory created later with the same
+        path (e.g., after a rename) is watched and read as a new one. (No
+        IN_IGNORED event arrives for directories that are moved away.)
+        """
+        pending = [path]
+
+        while pending:
+            path = pending.pop()
+            pending.extend(self.subdirectories(path))
+            _my_listdir_cache.pop(path, None)
+            self.watcher.unwatch(path)
+            self.scanner.dequeue(path)
+            self.empty_directories.discard(path)
+
+    def subdirectories(self, path):
+        """Return the subdirectories of path in _my_listdir_cache."""
+        return [os.path.join(path, entry)
+                for entry, is_dir in _listing_entries(path).iteritems()
+                if is_dir]
+
+    def _index_entries(self, directory, entries):
+        """Add entries of directory to the index, with their cached contents.
+
+        Returns True if all the subdirectories were in _my_listdir_cache.
+        """
+        complete = True
+        can_play = minirok.Globals.engine.can_play_path
+        pending = [(directory, entries)]
+
+        while pending:
+            directory, entries = pending.pop()
+            paths = []
+            playable = False
+            for entry, is_dir in entries.iteritems():
+                path = os.path.join(directory, entry)
+                if is_dir:
+                    paths.append(path)
+                    if path in _my_listdir_cache:
+                        pending.append((path, _my_listdir_cache[path][1]))
+                    else:
+                        complete = False
+                elif can_play(path):
+                    paths.append(path)
+                    playable = True
+            self.search_index.add(paths)
+
+            if playable and directory in self.empty_directories:
+                # It's no longer empty, nor its parents.
+                while directory in self.empty_directories:
+                    self.empty_directories.remove(directory)
+                    revived = directory
+                    directory = os.path.dirname(directory)
+                self._revive_directory(revived)
+
+        return complete
+
+    def _revive_directory(self, path):
+        """Add back a directory pruned as empty, if its parent is populated."""
+        parent_path = os.path.dirname(path)
+        parent = self.find_directory_item(parent_path)
+
+        if (parent is not None and hasattr(parent, 'mtime')
+                and parent_path in _my_listdir_cache):
+            _populate_tree(parent, parent_path, force_refresh=True, read=False)
+            if parent is not self.invisibleRootItem():
+                parent.sortChildren(0, QtCore.Qt.AscendingOrder)
+
+    def _unindex_tree(self, path):
+        """Remove a path from the index, and its cached contents."""
+        removed = []
+        pending = [path]
+
+        while pending:
+            path = pending.pop()
+            removed.append(path)
+            pending.extend(os.path.join(path, entry)
+                           for entry in _listing_entries(path))
+
+        self.search_index.remove(removed)
 
     def slot_search_finished(self, null_search):
         """Open the visible items, closing items opened in the previous search.
@@ -241,25 +568,25 @@ class TreeView(QtGui.QTreeWidget):
         config.writeEntry(self.CONFIG_RECURSE_OPTION,
                           QtCore.QVariant(self._recurse))
 
+        if self.root is not None and self._recurse:
+            _save_snapshot(self.root)
+
 ##
 
 class TreeViewItem(QtGui.QTreeWidgetItem):
 
     IS_DIR = 0  # TODO: Use QTreeWidgetItem::type() instead?
 
-    def __init__(self, path, root):
+    def __init__(self, path, filename):
+        # The filename is passed in because _populate_tree() already has it;
+        # no relative path is kept, since searches go through SearchIndex.
         self.path = path
-        dirname, self.filename = os.path.split(path)
+        self.filename = filename
 
         # Note that we don't pass a parent here, because I've found that
         # to be slow. Instead, we always construct parentless items, and
         # add them to the parent with addChildren() in _populate_tree().
-        QtGui.QTreeWidgetItem.__init__(self,
-                                       [util.unicode_from_path(self.filename)])
-
-        # optimization for TreeViewSearchLine.itemMatches() below
-        rel_path = re.sub('^%s/*' % re.escape(root), '', path)
-        self.unicode_rel_path = util.unicode_from_path(rel_path)
+        QtGui.QTreeWidgetItem.__init__(self, [util.unicode_from_path(filename)])
 
     def __lt__(self, other):
         """Sorts directories before files, and by filename after that."""
@@ -274,8 +601,8 @@ class DirectoryItem(TreeViewItem):
 
     IS_DIR = 1
 
-    def __init__(self, path, root):
-        TreeViewItem.__init__(self, path, root)
+    def __init__(self, path, filename):
+        TreeViewItem.__init__(self, path, filename)
         self.setChildIndicatorPolicy(QtGui.QTreeWidgetItem.ShowIndicator)
 
     def repopulate(self):
@@ -301,13 +628,16 @@ class TreeViewSearchLine(util.SearchLineWithReturnKey):
     to match *in the same order*, as happens in the standard
     KListViewSearchLine.
 
+    Matching paths are computed all at once with the TreeView's SearchIndex
+    when the search string changes, and items are created for them if needed;
+    itemMatches() is then just a lookup.
+
     When the user stops typing, a search_finished(bool empty_search) signal is
     emitted.
     """
     def __init__(self, *args):
         util.SearchLineWithReturnKey.__init__(self, *args)
         self.string = None
-        self.regexes = []
         self.timer = QtCore.QTimer(self)
         self.timer.setSingleShot(True)
 
@@ -329,30 +659,27 @@ class TreeViewSearchLine(util.SearchLineWithReturnKey):
         if pystring:
             if pystring != self.string:
                 self.string = pystring
-                self.regexes = [re.compile(re.escape(pat), re.I | re.U)
-                                for pat in pystring.split()]
+                index = self.search_index()
+                index.set_query(pystring.split())
+                # Create the items for the matches, so that they can be shown.
+                self.treeWidget().materialize(index.matching_paths())
         else:
             self.string = None
+            self.search_index().set_query(None)
 
         kdeui.KTreeWidgetSearchLine.updateSearch(self, string)
         self.timer.start(400)
 
     def itemMatches(self, item, string):
         # We don't need to do anything with the string parameter here because
-        # self.string and self.regexes are always set in updateSearch() above.
+        # the query is always set in updateSearch() above.
         if self.string is None:
             return True
-
-        try:
-            item_text = item.unicode_rel_path
-        except AttributeError:
-            item_text = unicode(item.text(0))
-
-        for regex in self.regexes:
-            if not regex.search(item_text):
-                return False
         else:
-            return True
+            return self.search_index().matches(item.path)
+
+    def search_index(self):
+        return self.treeWidget().search_index
 
 
 class TreeViewSearchLineWidget(kdeui.KTreeWidgetSearchLineWidget):
@@ -363,6 +690,302 @@ class TreeViewSearchLineWidget(kdeui.KTreeWidgetSearchLineWidget):
 
 ##
 
+class SearchIndex(object):
+    """Index of the relative paths of the files and directories in a TreeView.
+
+    The index is kept by path, not by item, so that it can be searched before
+    the items are created (see TreeView.materialize()).
+
+    Paths are lowercased and concatenated into a single buffer, separated by
+    newlines, so that the paths containing a word can be found with a few
+    calls to str.find() instead of testing every path. The buffer is rebuilt
+    lazily, on the first search after paths are added or removed.
+
+    A query (a list of words, all of which must be contained in the relative
+    path) is set with set_query(), and paths can be checked against it with
+    matches(). Paths added while a query is active are tested against it
+    right away, and can be retrieved with pop_new_matches().
+    """
+    def __init__(self):
+        self._prefix = None
+        self._paths = {}  # path -> lowercased relative path
+        self._buffer = None
+        self._offsets = []
+        self._buffer_paths = []
+
+        self._words = None
+        self._matches = set()
+        self._new_matches = []
+
+    def __contains__(self, path):
+        return path in self._paths
+
+    ##
+
+    def add(self, paths):
+        prefix_len = len(self._prefix)
+        for path in paths:
+            rel_path = util.unicode_from_path(path[prefix_len:]).lower()
+            self._paths[path] = rel_path
+            if self._words is not None and self._path_matches(rel_path):
+                self._matches.add(path)
+                self._new_matches.append(path)
+        self._buffer = None
+
+    def remove(self, paths):
+        for path in paths:
+            if self._paths.pop(path, None) is not None:
+                self._matches.discard(path)
+                self._buffer = None
+
+    def reset(self, root):
+        """Empty the index, and make paths relative to root from now on."""
+        self._prefix = os.path.join(root, '')
+        self._paths.clear()
+        self._matches.clear()
+        self._new_matches = []
+        self._buffer = None
+        self._offsets = []
+        self._buffer_paths = []
+
+    ##
+
+    def set_query(self, words):
+        """Set the current query, and compute the set of matching paths.
+
+        If the new query refines the previous one (e.g., the user typed more
+        characters), only the paths that matched are tested again; if it
+        broadens it, only the paths that did not match are. If words is None,
+        the current query is dropped.
+        """
+        old_words = self._words
+        self._new_matches = []
+
+        if not words:
+            self._words = None
+            self._matches = set()
+            return
+
+        # Search first for the longest word, which probably has the fewest
+        # matches; the rest of the words are only tested against those.
+        self._words = sorted((w.lower() for w in words), key=len, reverse=True)
+
+        if old_words is not None and util.query_refines(self._words, old_words):
+            self._matches = self._filter(self._matches)
+        elif (old_words is not None
+              and util.query_refines(old_words, self._words)):
+            rejected = [path for path in self._paths
+                        if path not in self._matches]
+            self._matches.update(self._filter(rejected))
+        else:
+            self._matches = self._filter(self._find(self._words[0]))
+
+    def matches(self, path):
+        return path in self._matches
+
+    def matching_paths(self):
+        return self._matches
+
+    def pop_new_matches(self):
+        """Return the paths added since set_query() that match the query."""
+        new_matches = self._new_matches
+        self._new_matches = []
+        return new_matches
+
+    ##
+
+    def _filter(self, paths):
+        """Return the set of the given paths that match the current query."""
+        rel_paths = self._paths
+        return set(path for path in paths
+                   if self._path_matches(rel_paths[path]))
+
+    def _path_matches(self, rel_path):
+        for word in self._words:
+            if word not in rel_path:
+                return False
+        else:
+            return True
+
+    def _find(self, word):
+        """Return the set of paths whose relative path contains word."""
+        if self._buffer is None:
+            self._build()
+
+        found = set()
+        buf = self._buffer
+        offsets = self._offsets
+        last = len(offsets) - 1
+        pos = buf.find(word)
+
+        while pos >= 0:
+            i = bisect.bisect_right(offsets, pos) - 1
+            found.add(self._buffer_paths[i])
+            if i == last:
+                break
+            pos = buf.find(word, offsets[i + 1])  # Skip to the next path.
+
+        return found
+
+    def _build(self):
+        self._buffer_paths = self._paths.keys()
+        rel_paths = [self._paths[path] for path in self._buffer_paths]
+        self._buffer = u'\n'.join(rel_paths)
+        self._offsets = offsets = []
+
+        offset = 0
+        for rel_path in rel_paths:
+            offsets.append(offset)
+            offset += len(rel_path) + 1
+
+##
+
+class DirectoryWatcher(QtCore.QObject):
+    """Watch directories for changes using inotify, if available.
+
+    A "directory_changed" signal with the path is emitted for each watched
+    directory whose contents change (signals are delayed and coalesced a bit,
+    since downloads tend to produce many events in a row). Before those, a
+    "directory_moved" signal is emitted for each watched directory that was
+    renamed away: its path must be forgotten, as it no longer refers to it.
+
+    Directories whose contents were read after they started being watched, and
+    that have not changed since, are considered up to date: their contents do
+    not need to be checked on disk. If pyinotify is not available, or if the
+    kernel's limit of watches is exhausted, directories will never be up to
+    date, and callers should check the disk as usual.
+    """
+    MASK = 0
+    DELAY = 500  # In ms.
+
+    if _has_pyinotify:
+        MASK = (pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_MOVE_SELF)
+
+    def __init__(self, parent=None):
+        QtCore.QObject.__init__(self, parent)
+
+        self.enabled = _has_pyinotify
+        self._watches = {}  # path -> watch descriptor
+        self._paths = {}  # watch descriptor -> path
+        self._up_to_date = set()
+        self._changed = set()
+        self._moved = set()
+
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self.connect(self._timer,
+                     QtCore.SIGNAL('timeout()'),
+                     self._slot_emit_changed)
+
+        if self.enabled:
+            self._wm = pyinotify.WatchManager()
+            self._notifier = pyinotify.Notifier(self._wm, self._process_event)
+            self._socket_notifier = QtCore.QSocketNotifier(
+                self._wm.get_fd(), QtCore.QSocketNotifier.Read, self)
+            self.connect(self._socket_notifier,
+                         QtCore.SIGNAL('activated(int)'),
+                         self._slot_read_events)
+
+    ##
+
+    def watch(self, path):
+        """Start watching a directory; returns True if successful."""
+        if not self.enabled:
+            return False
+        elif path in self._watches:
+            return True
+
+        wd = self._wm.add_watch(path, self.MASK, quiet=True).get(path, -1)
+
+        if wd < 0:
+            # Most likely, fs.inotify.max_user_watches was reached. Stop trying
+            # to add more watches: directories not watched will be stat()'ed.
+            minirok.logger.warn('could not watch %r, disabling further '
+                                'directory watches', path)
+            self.enabled = False
+            return False
+        else:
+            self._watches[path] = wd
+            self._paths[wd] = path
+            return True
+
+    def unwatch(self, path):
+        """Stop watching a directory, if it was watched."""
+        wd = self._watches.pop(path, None)
+
+        if wd is not None:
+            self._wm.rm_watch(wd, quiet=True)
+            del self._paths[wd]
+
+        self._up_to_date.discard(path)
+        self._changed.discard(path)
+        self._moved.discard(path)
+
+    def clear(self):
+        if self._watches:
+            self._wm.rm_watch(self._watches.values(), quiet=True)
+        self._watches.clear()
+        self._paths.clear()
+        self._up_to_date.clear()
+        self._changed.clear()
+        self._moved.clear()
+        self.enabled = _has_pyinotify
+
+    def is_up_to_date(self, path):
+        return path in self._up_to_date
+
+    def mark_up_to_date(self, path):
+        if path in self._watches:
+            self._up_to_date.add(path)
+
+    ##
+
+    def _slot_read_events(self, fd):
+        self._notifier.read_events()
+        self._notifier.process_events()
+
+    def _process_event(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            # Events were lost: don't trust any directory.
+            self._up_to_date.clear()
+            return
+
+        # The path is looked up by watch descriptor, because pyinotify updates
+        # the paths of directories that are moved, and we want the old one.
+        path = self._paths.get(event.wd)
+
+        if path is None:
+            return
+        elif event.mask & pyinotify.IN_IGNORED:
+            # The directory was removed; its parent will get an event too.
+            del self._paths[event.wd]
+            del self._watches[path]
+            self._up_to_date.discard(path)
+        elif event.mask & pyinotify.IN_MOVE_SELF:
+            # The directory was moved away, and the watch follows it.
+            self._moved.add(path)
+            self._timer.start(self.DELAY)
+        else:
+            self._up_to_date.discard(path)
+            self._changed.add(path)
+            self._timer.start(self.DELAY)
+
+    def _slot_emit_changed(self):
+        moved = sorted(self._moved)
+        changed = sorted(self._changed)  # Parents before their children.
+        self._moved.clear()
+        self._changed.clear()
+
+        for path in moved:
+            self.emit(QtCore.SIGNAL('directory_moved'), path)
+
+        for path in changed:
+            self.emit(QtCore.SIGNAL('directory_changed'), path)
+
+##
+
 def _get_children(toplevel, filter_func=None):
     """Returns a filtered list of all direct children of toplevel.
 
@@ -374,28 +997,37 @@ def _get_children(toplevel, filter_func=None):
             if filter_func is None or filter_func(item)]
 
 
-def _populate_tree(parent, directory, force_refresh=False):
+def _populate_tree(parent, directory, force_refresh=False, read=True):
     """A helper function to populate either a TreeView or a DirectoryItem.
 
     When populating, this function sets parent.mtime, and when invoked later on
     the same parent, it will return immediately if the mtime of directory is
-    not different. If it is different, a refresh will be performed, keeping as
-    many existing children as possible.
+    not different (unless force_refresh is True). If it is different, a refresh
+    will be performed, keeping as many existing children as possible.
 
-    It updates TreeView's empty_directories set as appropriate.
+    If read is False, the contents of the directory will not be read from
+    disk, and the ones in _my_listdir_cache will be used. They will not be
+    read either if the TreeView's watcher knows the directory did not change.
+
+    Subdirectories in the TreeView's empty_directories set are skipped.
     """
-    _my_listdir(directory)
+    # Pointer to the parent QTreeWidget, for empty_directories, watcher and
+    # directory_items.
+    treewidget = parent.treeWidget()
+
+    if read and not treewidget.watcher.is_up_to_date(directory):
+        treewidget.read_directory(directory)
+        treewidget.watcher.mark_up_to_date(directory)
+
     mtime, contents = _my_listdir_cache[directory]
 
-    if mtime == getattr(parent, 'mtime', None):
+    if mtime == getattr(parent, 'mtime', None) and not force_refresh:
         return
     else:
         parent.mtime = mtime
-        prune_this_parent = True
         files = set(contents.keys())
 
     # Check filesystem contents against existing children.
-    # TODO: What's up with prune_this_parent when refreshing.
     children = _get_children(parent)
     if children:
         # Map basename -> item, to compare with files.
@@ -406,22 +1038,26 @@ def _populate_tree(parent, directory, force_refresh=False):
         # Remove items no longer found in the filesystem.
         for k in keys - common:
             parent.removeChild(mapping[k])
+            treewidget.forget_item(mapping[k])
 
         # Do not re-add items already in the tree view.
         files -= common
 
-    # Pointer to the parent QTreeWidget, for empty_directories.
-    treewidget = parent.treeWidget()
-
     items = []
+    prefix = os.path.join(directory, '')
+    can_play = minirok.Globals.engine.can_play_path
+    empty_directories = treewidget.empty_directories
+    directory_items = treewidget.directory_items
+
     for filename in files:
-        path = os.path.join(directory, filename)
-        if stat.S_ISDIR(contents[filename].st_mode):
-            item = DirectoryItem(path, treewidget.root)
-            treewidget.empty_directories.add(item)
-        elif minirok.Globals.engine.can_play_path(path):
-            item = FileItem(path, treewidget.root)
-            prune_this_parent = False
+        path = prefix + filename
+        if contents[filename]:
+            if path in empty_directories:
+                continue
+            item = directory_items[path] = DirectoryItem(path, filename)
+            treewidget.watcher.watch(path)
+        elif can_play(path):
+            item = FileItem(path, filename)
         else:
             continue
         items.append(item)
@@ -429,46 +1065,187 @@ def _populate_tree(parent, directory, force_refresh=False):
     if items:
         parent.addChildren(items)
 
-    if not prune_this_parent:
-        while parent:
-            treewidget.empty_directories.discard(parent)
-            parent = parent.parent()
-
 
 # This is a dict like:
-# { path: (mtime, { entry1: stat_struct, entry2: stat_struct, ... }), ... }
+# { path: (mtime, { entry1: is_dir, entry2: is_dir, ... }), ... }
+#
+# It's only modified from the main thread, but _scan_directory() reads it from
+# scanner threads.
 _my_listdir_cache = {}
 
-def _my_listdir(path):
-    """Read directory contents, storing results in a dictionary cache.
+def _listing_entries(path):
+    """Return the cached contents of a directory, or an empty dict."""
+    try:
+        return _my_listdir_cache[path][1]
+    except KeyError:
+        return {}
+
 
-    When invoked over a previously read directory, its contents will only be
-    re-read from the filesystem if the mtime is different to the mtime the last
-    time the contents were read.
+def _find_empty_directories(root):
+    """Return the set of directories under root without playable files.
+
+    Only _my_listdir_cache is looked at; directories not in it are assumed
+    not to be empty.
+    """
+    empty = set()
+    can_play = minirok.Globals.engine.can_play_path
+
+    def _has_playable(directory):
+        if directory not in _my_listdir_cache:
+            return True
+        playable = False
+        for entry, is_dir in _my_listdir_cache[directory][1].iteritems():
+            path = os.path.join(directory, entry)
+            if is_dir:
+                playable = _has_playable(path) or playable  # Recurse all.
+            elif not playable and can_play(path):
+                playable = True
+        if not playable:
+            empty.add(directory)
+        return playable
+
+    _has_playable(root)
+    empty.discard(root)
+    return empty
+
+
+def _scan_directory(path):
+    """Read a directory for the TreeView's scanner (to be used from a worker)."""
+    mtime = _my_listdir_cache.get(path, (None, None))[0]
+    return _read_directory(path, mtime)
+
+
+def _store_listing(path, listing):
+    """Store in _my_listdir_cache the result of _read_directory()."""
+    if listing is None:
+        return  # Unchanged.
+    elif listing[0] is None:
+        _my_listdir_cache.setdefault(path, listing)  # Error.
+    else:
+        _my_listdir_cache[path] = listing
+
+
+def _read_directory(path, cached_mtime=None):
+    """Read directory contents, returning a tuple (mtime, contents).
+
+    contents is a dict mapping each entry to whether it is a directory. If
+    the mtime of the directory is cached_mtime, None will be returned without
+    reading its contents. If the directory cannot be read, the returned tuple
+    will be (None, {}).
+
+    If the scandir module is available, the type of each entry will be taken
+    from the directory itself when the filesystem provides it, instead of
+    calling stat() on every entry. Either way, symlinks are followed, and
+    entries that are neither directories nor regular files (e.g. fifos, or
+    broken symlinks) are left out.
     """
     try:
         mtime = os.stat(path).st_mtime
     except OSError, e:
         minirok.logger.warn('could not stat %r: %s', path, e.strerror)
-        _my_listdir_cache.setdefault(path, (None, {}))
-        return
+        return (None, {})
 
-    if mtime == _my_listdir_cache.get(path, (None, None))[0]:
-        return
+    if mtime == cached_mtime:
+        return None
+
+    d = {}
 
     try:
-        contents = os.listdir(path)
+        if _has_scandir:
+            for entry in scandir(path):
+                try:
+                    # These only stat() if needed, and follow symlinks.
+                    if entry.is_dir():
+                        d[entry.name] = True
+                    elif entry.is_file():
+                        d[entry.name] = False
+                    elif entry.is_symlink():
+                        os.stat(entry.path)  # Broken link: get the error.
+                except OSError, e:
+                    minirok.logger.warn('could not access %r: %s',
+                                        entry.path, e.strerror)
+        else:
+            for entry in os.listdir(path):
+                try:
+                    entryp = os.path.join(path, entry)
+                    mode = os.stat(entryp).st_mode
+                    if stat.S_ISDIR(mode):
+                        d[entry] = True
+                    elif stat.S_ISREG(mode):
+                        d[entry] = False
+                except OSError, e:
+                    minirok.logger.warn('could not access %r: %s',
+                                        entryp, e.strerror)
     except OSError, e:
         minirok.logger.warn('could not listdir %r: %s', path, e.strerror)
-        _my_listdir_cache.setdefault(path, (None, {}))
+        return (None, {})
+
+    return (mtime, d)
+
+
+##
+
+SNAPSHOT_VERSION = 2
+
+def _snapshot_path(root):
+    appdata = str(kdecore.KGlobal.dirs().saveLocation('appdata'))
+    return os.path.join(appdata, APPDATA_TREE_CACHE,
+                        hashlib.md5(root).hexdigest())
+
+
+def _load_snapshot(root):
+    """Load into _my_listdir_cache the snapshot saved for root, if any.
+
+    Nothing is done if root is already in the cache. Entries loaded from the
+    snapshot will be validated against the mtime of each directory when they
+    are next read with TreeView.read_directory() or _scan_directory().
+    """
+    if root in _my_listdir_cache:
         return
 
-    d = {}
-    for entry in contents:
+    try:
+        f = open(_snapshot_path(root), 'rb')
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            minirok.logger.warn('could not open tree snapshot: %s', e)
+        return
+
+    try:
         try:
-            entryp = os.path.join(path, entry)
-            d[entry] = os.stat(entryp)
-        except OSError, e:
-            minirok.logger.warn('could not access %r: %s', entryp, e.strerror)
+            version, snapshot_root, entries = cPickle.load(f)
+        except Exception, e:
+            minirok.logger.warn('could not load tree snapshot: %s', e)
+            return
+    finally:
+        f.close()
+
+    if version == SNAPSHOT_VERSION and snapshot_root == root:
+        for path, listing in entries.iteritems():
+            _my_listdir_cache.setdefault(path, listing)
 
-    _my_listdir_cache[path] = (mtime, d)
+
+def _save_snapshot(root):
+    """Save the entries of _my_listdir_cache under root to disk."""
+    prefix = os.path.join(root, '')
+    entries = {}
+
+    for path, listing in _my_listdir_cache.iteritems():
+        if (listing[0] is not None
+            and (path == root or path.startswith(prefix))):
+            entries[path] = listing
+
+    path = _snapshot_path(root)
+    tmp_path = path + '.new'
+
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.mkdir(os.path.dirname(path))
+        f = open(tmp_path, 'wb')
+        try:
+            cPickle.dump((SNAPSHOT_VERSION, root, entries), f,
+                         cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+    except (IOError, OSError), e:
+        minirok.logger.error('could not save tree snapshot: %s', e)
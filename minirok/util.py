@@ -6,6 +6,7 @@
 
 import minirok
 
+import collections
 import os
 import random
 import re
@@ -119,8 +120,11 @@ def playable_from_untrusted(files, warn=False):
       files: list of paths.
       warn: if true, emit a warning for each skipped file, stating the reason;
         if false, debug() statements will be emitted instead.
+
+    See PlayableFilesWalker for a version that does not block.
     """
     result = []
+    seen = set()
 
     if warn:
         warn = minirok.logger.warn
@@ -144,7 +148,8 @@ def playable_from_untrusted(files, warn=False):
                     append_path(os.path.join(path, entry))
         elif stat.S_ISREG(mode):
             if minirok.Globals.engine.can_play_path(path):
-                if path not in result:
+                if path not in seen:
+                    seen.add(path)
                     result.append(path)
             else:
                 warn('skipping %r: not a playable format', path)
@@ -178,6 +183,26 @@ def contiguous_chunks(intlist):
     return map(tuple, result)
 
 
+def query_refines(new_words, old_words):
+    """Return whether a multi-word query is a refinement of another.
+
+    This is the case when each of old_words is contained in some of new_words,
+    which means anything matching new_words also matches old_words. (Swapping
+    the arguments tells whether new_words is a broadening of old_words.)
+
+    >>> query_refines(['beatles', 'road'], ['beat'])
+    True
+    """
+    for old in old_words:
+        for new in new_words:
+            if old in new:
+                break
+        else:
+            return False
+    else:
+        return True
+
+
 def ensure_utf8(string):
     """Return an UTF-8 string out of the passed string.
 
@@ -310,15 +335,125 @@ class QTimerWithPause(QtCore.QObject):
 
 ##
 
-class RandomOrderedList(list):
-    """A list where append() inserts items at a random position."""
+class RandomQueue(object):
+    """A collection of items that are retrieved in random order.
+
+    Items are kept in a list, plus a dict with the index of each item in it.
+    Adding an item, removing any given item, and popping a random one are all
+    O(1): the last item of the list is moved into the slot being freed.
+    """
+    def __init__(self):
+        self._items = []
+        self._index = {}  # item -> index in _items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._index
 
     def append(self, item):
-        self.insert(random.randrange(len(self)+1), item)
+        """Add an item (nothing is done if it's already present)."""
+        if item not in self._index:
+            self._index[item] = len(self._items)
+            self._items.append(item)
 
-    def extend(self, seq):
-        list.extend(self, seq)
-        random.shuffle(self)
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def remove(self, item):
+        """Remove an item, raising ValueError if it's not present."""
+        try:
+            i = self._index.pop(item)
+        except KeyError:
+            raise ValueError('item not in RandomQueue')
+
+        last = self._items.pop()
+        if i < len(self._items):
+            self._items[i] = last
+            self._index[last] = i
+
+    def discard(self, item):
+        """Remove an item if present."""
+        if item in self._index:
+            self.remove(item)
+
+    def pop(self):
+        """Remove and return a random item, raising IndexError if empty."""
+        item = self.peek()
+        self.remove(item)
+        return item
+
+    def peek(self):
+        """Return a random item without removing it."""
+        if not self._items:
+            raise IndexError('peek from an empty RandomQueue')
+        return self._items[random.randrange(len(self._items))]
+
+    def clear(self):
+        self._items[:] = []
+        self._index.clear()
+
+##
+
+class IndexedQueue(object):
+    """A FIFO queue with O(1) membership test and removal of any item.
+
+    Items must be hashable, and can only be in the queue once: appending an
+    item that is already queued does nothing. Removed items are dropped from
+    the index straight away, and their slot in the underlying deque is skipped
+    (or compacted away) later.
+    """
+    def __init__(self, items=()):
+        self._seq = 0
+        self._index = {}  # item -> sequence number of its slot in _deque.
+        self._deque = collections.deque()
+        self.extend(items)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, item):
+        return item in self._index
+
+    def __iter__(self):
+        for seq, item in list(self._deque):
+            if self._index.get(item) == seq:
+                yield item
+
+    def append(self, item):
+        if item not in self._index:
+            self._seq += 1
+            self._index[item] = self._seq
+            self._deque.append((self._seq, item))
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def discard(self, item):
+        """Remove item from the queue, if present."""
+        if self._index.pop(item, None) is not None:
+            if len(self._deque) > 2 * len(self._index) + 64:
+                self._compact()
+
+    def popleft(self):
+        """Remove and return the first item; raises IndexError if empty."""
+        while True:
+            seq, item = self._deque.popleft()
+            if self._index.get(item) == seq:
+                del self._index[item]
+                return item
+
+    def clear(self):
+        self._index.clear()
+        self._deque.clear()
+
+    def _compact(self):
+        self._deque = collections.deque(
+            (seq, item) for seq, item in self._deque
+            if self._index.get(item) == seq)
 
 ##
 
@@ -366,11 +501,11 @@ class Enum(object):
 def needs_lock(mutex_name):
     """Helper decorator for ThreadedWorker."""
     def decorator(function):
-        def wrapper(self, *args):
+        def wrapper(self, *args, **kwargs):
             mutex = getattr(self, mutex_name)
             mutex.lock()
             try:
-                return function(self, *args)
+                return function(self, *args, **kwargs)
             finally:
                 mutex.unlock()
         return wrapper
@@ -384,7 +519,23 @@ class ThreadedWorker(QtCore.QThread):
     The thread consumes items from a queue, and stores pairs (item, result)
     in a "done" queue. Whenever there are done items, the thread emits a
     "items_ready" signal.
+
+    To not flood the receiver, the signal is not emitted again until
+    pop_done() is called, and done items are batched: the signal is emitted
+    once BATCH_SIZE items are done, BATCH_INTERVAL seconds have passed since
+    the last one, or the queue becomes empty. (A timer in the thread that
+    created the worker takes care of the interval when no other item gets
+    done in the meantime.)
+
+    If the order_key attribute is set to a function, each thread takes up to
+    ORDER_WINDOW items from the queue at once, and processes them sorted by
+    the result of calling order_key on each (outside the lock, so it may do
+    I/O). Prioritized items are still processed before the rest of a window.
     """
+    BATCH_SIZE = 200
+    BATCH_INTERVAL = 0.05  # In seconds.
+    ORDER_WINDOW = 64
+
     def __init__(self, function):
         """Create a worker.
 
@@ -394,12 +545,23 @@ class ThreadedWorker(QtCore.QThread):
         QtCore.QThread.__init__(self)
 
         self._done = []
-        self._queue = []
-        self._mutex = QtCore.QMutex()  # For _queue.
-        self._mutex2 = QtCore.QMutex()  # For _done.
+        self._queue = IndexedQueue()
+        self._urgent = IndexedQueue()  # Items in _queue to process first.
+        self._running = set()  # Items taken from _queue, being processed.
+        self._mutex = QtCore.QMutex()  # For _queue, _urgent and _running.
+        self._mutex2 = QtCore.QMutex()  # For _done and the two below.
         self._pending = QtCore.QWaitCondition()
 
+        self._last_signal = 0
+        self._signal_pending = False
+        self._flush_scheduled = False
+
         self.function = function
+        self.order_key = None
+
+        self.connect(self,
+                     QtCore.SIGNAL('schedule_flush'),
+                     self._slot_schedule_flush)
 
     ##
 
@@ -418,43 +580,65 @@ class ThreadedWorker(QtCore.QThread):
     @needs_lock('_mutex2')
     def is_empty(self):
         """Returns True if both queues are empty."""
-        return len(self._queue) == 0 and len(self._done) == 0
+        return (len(self._queue) == 0 and len(self._running) == 0
+                and len(self._done) == 0)
+
+    @needs_lock('_mutex')
+    def is_idle(self):
+        """Returns True if no items are queued or being processed."""
+        return len(self._queue) == 0 and len(self._running) == 0
 
     @needs_lock('_mutex')
     def dequeue(self, item):
-        try:
-            self._queue.remove(item)
-        except ValueError:
-            pass
+        self._queue.discard(item)
+        self._urgent.discard(item)
+        self._running.discard(item)
+
+    @needs_lock('_mutex')
+    def prioritize(self, items):
+        """Process the given items before the rest of the queue.
+
+        Items not in the queue are ignored. Each call replaces the set of items
+        prioritized by the previous one, which go back to their normal place in
+        the queue.
+        """
+        self._urgent = IndexedQueue(x for x in items if x in self._queue)
 
     @needs_lock('_mutex')
     @needs_lock('_mutex2')
     def clear_queue(self):
         self._done[:] = []
-        self._queue[:] = []
+        self._queue.clear()
+        self._urgent.clear()
+        self._running.clear()
 
     @needs_lock('_mutex2')
     def pop_done(self):
         done = self._done[:]
         self._done[:] = []
+        self._signal_pending = False
         return done
 
     ##
 
     def run(self):
+        window = []  # Items taken in advance when using order_key, reversed.
+
         while True:
             self._mutex.lock()
             try:
                 while True:
                     try:
-                        # We just don't pop() the item here, because after
-                        # calling self.function(), we'll want to check that the
-                        # item is still in the queue (that is, that the queue
-                        # was not cleared in the meantime).
-                        item = self._queue[0]
+                        # The item is moved to _running while it's processed:
+                        # after calling self.function(), we'll want to check
+                        # that it is still there (that is, that the item was
+                        # not dequeued or the queue cleared in the meantime).
+                        item = self._pop_next(window)
                     except IndexError:
+                        self._maybe_emit_ready(force=True)
                         self._pending.wait(self._mutex)  # Unlocks and re-locks.
                     else:
+                        self._running.add(item)
                         break
             finally:
                 self._mutex.unlock()
@@ -463,9 +647,10 @@ class ThreadedWorker(QtCore.QThread):
 
             self._mutex.lock()
             try:
-                try:
-                    self._queue.remove(item)
-                except ValueError:
+                if item in self._running:
+                    self._running.remove(item)
+                    idle = not self._queue and not window
+                else:
                     continue
             finally:
                 self._mutex.unlock()
@@ -476,7 +661,271 @@ class ThreadedWorker(QtCore.QThread):
             finally:
                 self._mutex2.unlock()
 
-            self.emit(QtCore.SIGNAL('items_ready'))
+            self._maybe_emit_ready(force=idle)
+
+    def _maybe_emit_ready(self, force=False):
+        """Emit "items_ready" if appropriate (see the class docstring).
+
+        If force is True, the signal is emitted if there are any done items
+        and the previous signal has been attended.
+
+        Signals are emitted after unlocking _mutex2: when called from
+        _slot_flush(), receivers run right away in this same thread, and
+        they will call pop_done().
+        """
+        signal = None
+
+        self._mutex2.lock()
+        try:
+            if self._done and not self._signal_pending:
+                now = time.time()
+                delay = self._last_signal + self.BATCH_INTERVAL - now
+
+                if force or len(self._done) >= self.BATCH_SIZE or delay <= 0:
+                    self._last_signal = now
+                    self._signal_pending = True
+                    signal = ('items_ready',)
+                elif not self._flush_scheduled:
+                    # The next item may take long: don't wait for it to emit.
+                    self._flush_scheduled = True
+                    signal = ('schedule_flush', int(delay * 1000) + 1)
+        finally:
+            self._mutex2.unlock()
+
+        if signal is not None:
+            self.emit(QtCore.SIGNAL(signal[0]), *signal[1:])
+
+    def _slot_schedule_flush(self, msecs):
+        QtCore.QTimer.singleShot(msecs, self._slot_flush)
+
+    def _slot_flush(self):
+        self._mutex2.lock()
+        try:
+            self._flush_scheduled = False
+        finally:
+            self._mutex2.unlock()
+
+        self._maybe_emit_ready(force=True)
+
+    def _pop_next(self, window):
+        """Remove and return the next item to process.
+
+        The caller must hold _mutex. Raises IndexError if the queue is empty.
+
+        Args:
+          window: the list of items this thread took in advance, which will
+            be refilled if order_key is set.
+        """
+        if self._urgent:
+            item = self._urgent.popleft()
+            self._queue.discard(item)
+            return item
+
+        while window:
+            item = window.pop()
+            if item in self._running:  # Otherwise, dequeued in the meantime.
+                return item
+
+        if self.order_key is None or len(self._queue) < 2:
+            return self._queue.popleft()
+
+        items = []
+        while self._queue and len(items) < self.ORDER_WINDOW:
+            items.append(self._queue.popleft())
+        self._running.update(items)
+
+        self._mutex.unlock()
+        try:
+            keyed = sorted((self.order_key(item), i, item)
+                           for i, item in enumerate(items))
+        finally:
+            self._mutex.lock()
+
+        window[:] = [item for key, i, item in reversed(keyed)]
+        return self._pop_next(window)  # Priorities may have changed.
+
+
+class ThreadedWorkerPool(ThreadedWorker):
+    """A ThreadedWorker that processes several items at once.
+
+    This is useful when the function spends most of its time waiting for I/O
+    (e.g. reading files from NFS or a busy disk). The interface is the same
+    as ThreadedWorker's; start() will start all threads in the pool.
+    """
+    def __init__(self, function, threads):
+        """Create a pool of workers.
+
+        Args:
+          function: The function to invoke on each item; it will be invoked
+            from several threads concurrently.
+          threads: The number of threads in the pool.
+        """
+        ThreadedWorker.__init__(self, function)
+        self._helpers = [_HelperThread(self) for x in range(threads - 1)]
+
+    def start(self, *args):
+        ThreadedWorker.start(self, *args)
+        for thread in self._helpers:
+            thread.start(*args)
+
+
+class _HelperThread(QtCore.QThread):
+    """A thread that runs the loop of a ThreadedWorkerPool."""
+
+    def __init__(self, pool):
+        QtCore.QThread.__init__(self)
+        self.pool = pool
+
+    def run(self):
+        self.pool.run()
+
+##
+
+class PlayableFilesWalker(QtCore.QObject):
+    """Find playable files under a list of untrusted paths, in other threads.
+
+    This is the asynchronous counterpart of playable_from_untrusted(): paths
+    are stat()'ed and directories read by a pool of threads, and playable
+    files are passed to a callback as they are found. Files are passed in the
+    same order playable_from_untrusted() would return them, so a file is held
+    back until everything that comes before it is known.
+    """
+    THREADS = 4
+
+    def __init__(self, parent=None):
+        QtCore.QObject.__init__(self, parent)
+
+        self.pool = ThreadedWorkerPool(_examine_path, self.THREADS)
+        self.pool.start()
+
+        self.connect(self.pool,
+                     QtCore.SIGNAL('items_ready'),
+                     self._slot_results)
+
+    def walk(self, files, found, finished, warn=False):
+        """Start looking for playable files.
+
+        Args:
+          files: list of paths.
+          found: function to call with each list of playable files found.
+          finished: function to call, without arguments, at the end.
+          warn: as in playable_from_untrusted().
+        """
+        job = _WalkJob(found, finished, warn)
+        nodes = [_WalkNode(path, job) for path in files]
+        job.stack.append(nodes[::-1])
+        self.pool.queue_many(nodes)
+        self._release(job)
+
+    ##
+
+    def _slot_results(self):
+        jobs = set()
+
+        for node, result in self.pool.pop_done():
+            node.done = True
+            jobs.add(node.job)  # Skipped paths may release others, too.
+            if result is None:
+                continue
+            kind, value = result
+            if kind == 'dir':
+                children = [_WalkNode(os.path.join(node.path, entry), node.job)
+                            for entry in value]
+                node.children = children[::-1]
+                self.pool.queue_many(children)
+            else:
+                node.playable = value
+
+        for job in jobs:
+            self._release(job)
+
+    def _release(self, job):
+        """Pass to the job's callback the files whose turn has come."""
+        found = []
+        stack = job.stack
+
+        while stack:
+            nodes = stack[-1]
+            if not nodes:
+                stack.pop()
+                continue
+
+            node = nodes[-1]
+            if not node.done:
+                break
+
+            nodes.pop()
+            if node.children is not None:
+                stack.append(node.children)
+            elif node.playable and node.path not in job.seen:
+                job.seen.add(node.path)
+                found.append(node.path)
+
+        if found:
+            job.found(found)
+
+        if not stack:
+            job.finished()
+
+
+class _WalkJob(object):
+    """The state of a PlayableFilesWalker.walk() call."""
+
+    def __init__(self, found, finished, warn):
+        self.found = found
+        self.finished = finished
+        self.stack = []  # Lists of nodes to release, each one reversed.
+        self.seen = set()
+
+        if warn:
+            self.warn = minirok.logger.warn
+        else:
+            self.warn = minirok.logger.debug
+
+
+class _WalkNode(object):
+    """A path examined by PlayableFilesWalker."""
+
+    __slots__ = ['path', 'job', 'done', 'children', 'playable']
+
+    def __init__(self, path, job):
+        self.path = path
+        self.job = job
+        self.done = False
+        self.children = None  # For directories, reversed list of nodes.
+        self.playable = False
+
+
+def _examine_path(node):
+    """Examine the path of a _WalkNode (to be used from a worker).
+
+    Returns ('dir', sorted_entries), ('file', is_playable), or None if the
+    path is to be skipped.
+    """
+    path = node.path
+    warn = node.job.warn
+
+    try:
+        mode = os.stat(path).st_mode
+    except OSError, e:
+        warn('skipping %r: %s', path, e.strerror)
+        return None
+
+    if stat.S_ISDIR(mode):
+        try:
+            return ('dir', sorted(os.listdir(path)))
+        except OSError, e:
+            warn('skipping %r: %s', path, e.strerror)
+            return None
+    elif stat.S_ISREG(mode):
+        if minirok.Globals.engine.can_play_path(path):
+            return ('file', True)
+        else:
+            warn('skipping %r: not a playable format', path)
+            return ('file', False)
+    else:
+        warn('skipping %r: not a regular file', path)
+        return None
 
 ##
 
@@ -0,0 +1,138 @@
+#! /usr/bin/env python
+## Hey, Python: encoding=utf-8
+#
+# Copyright (c) 2007-2010 Adeodato Simó (dato@net.com.org.es)
+# Licensed under the terms of the MIT license.
+
+"""Check tag_reader.read_tags() on MP3 files against the EasyID3 path.
+
+read_tags() used to parse MP3 files twice: with mutagen.File() for the
+length, and again with EasyID3 for the tags. These tests generate MP3 files
+with ID3 tags, and check that the tags read now are the same, with about half
+the I/O. Run with -v to see the number of bytes read.
+
+Run from the top-level directory with: PYTHONPATH=. python tests/test_*.py
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mutagen
+import mutagen.easyid3
+import mutagen.id3
+import mutagen.mp3
+
+from minirok import tag_reader
+
+##
+
+# An MPEG-1 Layer III frame header: 128 kbps, 44100 Hz, no padding.
+MPEG_FRAME = '\xff\xfb\x90\x64' + '\x00' * 413
+MPEG_FRAMES = 1000  # About 26 seconds.
+
+TAGS = [
+    {'TRCK': u'3/12', 'TPE1': u'Adeodato Simó', 'TALB': u'Minirok',
+     'TIT2': u'Título'},
+    {'TRCK': u'7', 'TPE1': u'Artist', 'TIT2': u'No album'},
+    {'TPE1': [u'First artist', u'Second artist'], 'TIT2': u'Two artists'},
+    {},
+]
+
+COVER_SIZE = 200 * 1024  # Bytes of cover art in files with an APIC frame.
+
+##
+
+class ReadTagsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+
+        for i, frames in enumerate(TAGS):
+            for version in [3, 4]:
+                for cover in [False, True]:
+                    path = os.path.join(
+                        self.directory, '%d-v2.%d-%d.mp3' % (i, version, cover))
+                    self.write_mp3(path, frames, version, cover)
+                    self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_mp3(self, path, frames, version, cover):
+        f = open(path, 'wb')
+        try:
+            f.write(MPEG_FRAME * MPEG_FRAMES)
+        finally:
+            f.close()
+
+        if frames or cover:
+            id3 = mutagen.id3.ID3()
+            for frame, text in frames.iteritems():
+                id3.add(getattr(mutagen.id3, frame)(encoding=3, text=text))
+            if cover:
+                id3.add(mutagen.id3.APIC(encoding=3, mime='image/jpeg', type=3,
+                                         desc=u'', data='\x00' * COVER_SIZE))
+            id3.save(path, v2_version=version)
+
+    def read_tags_easyid3(self, path):
+        """Read tags like read_tags() did before, returning (tags, bytes)."""
+        fileobj = tag_reader.BlockCachedFile(path)
+        try:
+            info = mutagen.File(fileobj)
+        finally:
+            fileobj.close()
+
+        self.assert_(isinstance(info, mutagen.mp3.MP3))
+        length = info.info.length
+        nbytes = fileobj.bytes_read
+
+        fileobj = tag_reader.BlockCachedFile(path)
+        try:
+            try:
+                info = mutagen.easyid3.EasyID3(fileobj)
+            except mutagen.id3.ID3NoHeaderError:
+                info = mutagen.easyid3.EasyID3()
+        finally:
+            fileobj.close()
+            nbytes += fileobj.bytes_read
+
+        tags = {'Length': int(length)}
+        for column, key in [('Track', 'tracknumber'), ('Artist', 'artist'),
+                            ('Album', 'album'), ('Title', 'title')]:
+            try:
+                tags[column] = info[key][0]
+            except KeyError:
+                pass
+
+        return tags, nbytes
+
+    def test_same_tags(self):
+        for path in self.paths:
+            tags, warnings, io = tag_reader._read_tags_quietly(path)
+            self.assertEqual(tags, self.read_tags_easyid3(path)[0], path)
+            self.assertEqual(warnings, [])
+            self.assertEqual(io[3], 'MP3')
+
+    def test_io_halved(self):
+        old_bytes = new_bytes = 0
+
+        for path in self.paths:
+            new_bytes += tag_reader._read_tags_quietly(path)[2][1]
+            old_bytes += self.read_tags_easyid3(path)[1]
+
+        if '-v' in sys.argv:
+            print >>sys.stderr, ('\n%d files: %d bytes read with EasyID3, '
+                                 '%d bytes now' % (len(self.paths),
+                                                   old_bytes, new_bytes))
+
+        self.assert_(new_bytes * 2 <= old_bytes * 1.1,
+                     'read %d bytes, %d before' % (new_bytes, old_bytes))
+
+##
+
+if __name__ == '__main__':
+    unittest.main()
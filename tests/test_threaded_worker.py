@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+## Hey, Python: encoding=utf-8
+#
+# Copyright (c) 2007-2010 Adeodato Simó (dato@net.com.org.es)
+# Licensed under the terms of the MIT license.
+
+"""Smoke tests for util.ThreadedWorker.
+
+Run from the top-level directory with: PYTHONPATH=. python tests/test_*.py
+"""
+
+import sys
+import time
+import unittest
+
+from PyQt4 import QtCore
+
+from minirok import util
+
+##
+
+class ThreadedWorkerTest(unittest.TestCase):
+
+    TIMEOUT = 5  # In seconds.
+
+    def setUp(self):
+        self.app = (QtCore.QCoreApplication.instance()
+                    or QtCore.QCoreApplication(sys.argv))
+        self.done = []
+
+    def run_worker(self, worker, items):
+        """Queue items in a started worker, and collect its results."""
+        self.app.connect(worker, QtCore.SIGNAL('items_ready'),
+                         lambda: self.done.extend(worker.pop_done()))
+        worker.start()
+
+        try:
+            worker.queue_many(items)
+            deadline = time.time() + self.TIMEOUT
+            while len(self.done) < len(items) and time.time() < deadline:
+                self.app.processEvents(QtCore.QEventLoop.AllEvents, 50)
+        finally:
+            worker.terminate()  # There's no other way to stop it.
+            worker.wait()
+
+        return sorted(self.done)
+
+    def test_worker(self):
+        worker = util.ThreadedWorker(lambda x: x * 2)
+        self.assertEqual(self.run_worker(worker, [1, 2, 3]),
+                         [(1, 2), (2, 4), (3, 6)])
+
+    def test_slow_item_does_not_delay_results(self):
+        # Item 1 is done shortly after the signal for item 0, and it must be
+        # delivered by the flush timer, without waiting for item 2.
+        def function(x):
+            if x == 1:
+                time.sleep(0.1)
+            elif x == 2:
+                deadline = time.time() + self.TIMEOUT
+                while (1, 1) not in self.done and time.time() < deadline:
+                    time.sleep(0.01)
+            return x
+
+        worker = util.ThreadedWorker(function)
+        worker.BATCH_INTERVAL = 0.5
+        self.assertEqual(self.run_worker(worker, [0, 1, 2]),
+                         [(0, 0), (1, 1), (2, 2)])
+        self.assert_((1, 1) in self.done[:2])
+
+    def test_pool(self):
+        worker = util.ThreadedWorkerPool(lambda x: -x, 4)
+        items = range(1000)
+        self.assertEqual(self.run_worker(worker, items),
+                         [(x, -x) for x in items])
+
+##
+
+if __name__ == '__main__':
+    unittest.main()